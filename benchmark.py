@@ -0,0 +1,399 @@
+'''
+Benchmarks for the server's hot spots and regression checks of the game
+('checks'). Run from the repository root:
+    python benchmark.py [benchmark ...]
+
+Without arguments all benchmarks are run.
+'''
+import os, sys, time, random
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+import pygame as pg
+import pymunk as pm
+
+import server
+
+BENCH_MAPS = [m["terrain_file"] for m in server.MAPS]
+CRATERS = 50
+CRATER_RADIUS = 30
+BODIES = 40
+STEPS = 600
+TURNS = 20
+SOLVER_BODIES = [50, 100, 200, 400, 800]
+
+def load_terrain(terrain_file):
+    surface = pg.Surface((server.WORLD_WIDTH, server.WORLD_HEIGHT), flags=pg.SRCALPHA)
+    map_sprite = pg.image.load(terrain_file)
+    surface.blit(map_sprite, map_sprite.get_rect(bottomleft=(0, server.WORLD_HEIGHT)))
+    return server.TerrainMask.from_surface(surface)
+
+def crater_positions(count, seed=0):
+    rnd = random.Random(seed)
+    return [(rnd.randint(0, server.WORLD_WIDTH - 1), rnd.randint(0, server.WORLD_HEIGHT - 1)) for _ in range(count)]
+
+def report(name, times):
+    times = sorted(times)
+    avg = sum(times) / len(times)
+    print(f"    {name:<24} avg {1000 * avg:8.2f} ms   median {1000 * times[len(times) // 2]:8.2f} ms   max {1000 * times[-1]:8.2f} ms")
+
+def bench_crater_rebuild():
+    """
+    Cost of updating the collision map after a crater: rebuilding every
+    terrain chunk versus only the chunks the crater touches.
+    """
+    world = pg.Rect(0, 0, server.WORLD_WIDTH, server.WORLD_HEIGHT)
+    for terrain_file in BENCH_MAPS:
+        print(f"  {terrain_file} ({CRATERS} craters)")
+        for name, dirty_area in (
+            ("full rebuild", lambda area: world),
+            ("chunked rebuild", lambda area: area),
+        ):
+            mask = load_terrain(terrain_file)
+            terrain = server.Terrain(mask, pm.Space())
+            terrain.build()
+            times = []
+            for pos in crater_positions(CRATERS):
+                area = mask.erase_circle(pos, CRATER_RADIUS)
+                start = time.perf_counter()
+                terrain.invalidate(dirty_area(area))
+                terrain.rebuild()
+                times.append(time.perf_counter() - start)
+            report(name, times)
+
+def make_world(terrain_file, collider, bodies=BODIES, threaded=False):
+    """
+    Space with the cratered terrain of the map and boxes and balls falling on it.
+    """
+    space = pm.Space(threaded=threaded)
+    space.gravity = 0, 981
+    terrain = server.Terrain(load_terrain(terrain_file), space, collider=collider)
+    terrain.build()
+    for pos in crater_positions(CRATERS):
+        terrain.erase_circle(pos, CRATER_RADIUS)
+    terrain.rebuild()
+
+    rnd = random.Random(0)
+    for pos in crater_positions(bodies, seed=1):
+        body = pm.Body()
+        body.position = pos[0], rnd.randint(0, server.WORLD_HEIGHT // 3)
+        if rnd.random() < 0.5:
+            shape = pm.Poly.create_box(body, (40, 20))
+        else:
+            shape = pm.Circle(body, 5)
+        shape.mass = 1
+        space.add(body, shape)
+    return space, terrain
+
+def step_times(space):
+    times = []
+    for _ in range(STEPS):
+        start = time.perf_counter()
+        space.step(1 / server.TICK_RATE)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_terrain_colliders():
+    """
+    Terrain shape count and space.step cost with segment and convex polygon
+    colliders, with boxes and balls falling on the (cratered) terrain.
+    """
+    for terrain_file in BENCH_MAPS:
+        print(f"  {terrain_file} ({BODIES} bodies, {STEPS} steps)")
+        for collider in ('segments', 'polys'):
+            space, terrain = make_world(terrain_file, collider)
+            report(f"{collider} ({sum(len(c.shapes) for c in terrain.chunks)} shapes)", step_times(space))
+
+def bench_broadphase():
+    """
+    space.step cost with the bounding box tree and the spatial hash
+    broadphase, using each map's terrain collider. The faster one can be
+    set as the map's "broadphase" in server.MAPS.
+    """
+    for m in server.MAPS:
+        collider = m.get("terrain_collider", server.TERRAIN_COLLIDER)
+        print(f"  {m['terrain_file']} ({collider}, {BODIES} bodies, {STEPS} steps)")
+        medians = {}
+        for broadphase in ('bbtree', 'spatial_hash'):
+            space, terrain = make_world(m["terrain_file"], collider)
+            name = broadphase
+            if broadphase == 'spatial_hash':
+                dim, count = terrain.spatial_hash_params()
+                space.use_spatial_hash(dim, count)
+                name = f"spatial_hash ({dim:.0f} px, {count})"
+            times = step_times(space)
+            medians[broadphase] = sorted(times)[len(times) // 2]
+            report(name, times)
+        print(f"    fastest: {min(medians, key=medians.get)}")
+
+def bench_threaded_solver():
+    """
+    space.step cost with the single-threaded solver and the threaded one
+    on 1 thread (what 'auto' runs below the threshold) and on
+    SOLVER_THREADS threads as the bodies pile up on the terrain.
+    THREADED_SOLVER_OBJECTS in server.py should be where the threads get
+    faster on the server machine.
+    """
+    m = server.MAPS[server.DEFAULT_MAP]
+    collider = m.get("terrain_collider", server.TERRAIN_COLLIDER)
+    print(f"  {m['terrain_file']} ({collider}, {STEPS} steps, {os.cpu_count()} CPUs)")
+    pays_off = None
+    for bodies in SOLVER_BODIES:
+        medians = {}
+        # 'auto' runs a threaded space with 1 thread below the threshold
+        for threaded, threads in ((False, 1), (True, 1), (True, server.SOLVER_THREADS)):
+            space, terrain = make_world(m["terrain_file"], collider, bodies, threaded=threaded)
+            if threaded:
+                space.threads = threads
+            times = step_times(space)
+            medians[threaded, threads] = sorted(times)[len(times) // 2]
+            report(f"{bodies} bodies, {f'threaded x{threads}' if threaded else 'single'}", times)
+        if medians[True, server.SOLVER_THREADS] >= medians[False, 1]:
+            pays_off = None  # only counts if it stays faster with more bodies
+        elif pays_off is None:
+            pays_off = bodies
+    if pays_off is None:
+        print(f"    the threaded solver didn't pay off up to {SOLVER_BODIES[-1]} bodies")
+    else:
+        print(f"    the threaded solver pays off from {pays_off} bodies")
+
+def bench_simulation():
+    """
+    Headless game speed: the players of each map take turns aiming and
+    shooting until the shells have landed and everything is at rest.
+    """
+    for m, terrain_file in enumerate(BENCH_MAPS):
+        sim = server.Simulation(map_index=m)
+        for i in range(server.MAPS[m]["max_players"]):
+            sim.add_player(f"player {i}")
+        sim.initialize()
+        sim.run_until(sim.is_idle, 10 * server.TICK_RATE)
+        print(f"  {terrain_file} ({sim.clients.count()} players, {TURNS} turns)")
+        times = []
+        start_tick = sim.current_tick
+        for turn in range(TURNS):
+            start = time.perf_counter()
+            player = sim.current_player
+            sim.key_down(player, pg.K_UP)
+            sim.run(10 + 7 * turn % 40)
+            sim.key_up(player, pg.K_UP)
+            sim.key_up(player, pg.K_SPACE)
+            sim.run_until(sim.is_idle, 10 * server.TICK_RATE)
+            sim.key_up(player, pg.K_TAB)
+            sim.run()
+            times.append(time.perf_counter() - start)
+        report("turn", times)
+        ticks = (sim.current_tick - start_tick) / sum(times)
+        print(f"    {ticks:.0f} ticks/s ({ticks / server.TICK_RATE:.0f}x real time)")
+        sim.stop()
+
+def play_turns(sim, turns, after_step=None):
+    """
+    The players take turns aiming and shooting like in bench_simulation.
+    after_step() is called after every step.
+    """
+    def run(steps=1):
+        for _ in range(steps):
+            sim.run()
+            if after_step:
+                after_step()
+
+    for turn in range(turns):
+        player = sim.current_player
+        sim.key_down(player, pg.K_UP)
+        run(10 + 7 * turn % 40)
+        sim.key_up(player, pg.K_UP)
+        sim.key_up(player, pg.K_SPACE)
+        for _ in range(10 * server.TICK_RATE):
+            run()
+            if sim.is_idle():
+                break
+        sim.key_up(player, pg.K_TAB)
+        run()
+
+def start_room(map_index=server.DEFAULT_MAP, send_message_cb=None, lockstep=False):
+    sim = server.Simulation(map_index, send_message_cb, lockstep)
+    for i in range(server.MAPS[map_index]["max_players"]):
+        sim.add_player(f"player {i}")
+    sim.initialize()
+    sim.run_until(sim.is_idle, 10 * server.TICK_RATE)
+    return sim
+
+def fire_shell(sim, position, velocity):
+    shell = server.Projectile(position)
+    shell.velocity = velocity
+    shell.set_owner(sim.current_player.id)
+    sim.add_obj(shell)
+    return shell
+
+def check_ballistic_flight():
+    """
+    A shell flying outside the physics explodes at the same tick and place
+    as one stepped by the physics all the way.
+    """
+    results = []
+    ballistic_steps = server.BALLISTIC_STEPS
+    for steps in (ballistic_steps, 0):
+        server.BALLISTIC_STEPS = steps
+        try:
+            sim = start_room(1)  # open sky above the obstacle course
+            shell = fire_shell(sim, (300, 300), (350, -300))
+            flew_outside = False
+            while not shell.exploded:
+                sim.run()
+                flew_outside = flew_outside or shell.flight is not None
+                if sim.current_tick > 10 * server.TICK_RATE:
+                    return "the shell didn't land"
+            results.append((sim.current_tick, sim.craters.entries, flew_outside))
+            sim.stop()
+        finally:
+            server.BALLISTIC_STEPS = ballistic_steps
+    (tick, craters, flew_outside), (physics_tick, physics_craters, _) = results
+    if not flew_outside:
+        return "the shell never left the physics"
+    if tick != physics_tick or len(craters) != 1 or len(physics_craters) != 1:
+        return f"landed at tick {tick} with {len(craters)} craters, physics at {physics_tick} with {len(physics_craters)}"
+    (_, pos, _), (_, physics_pos, _) = craters[0], physics_craters[0]
+    if (pm.Vec2d(*pos) - physics_pos).length > 1e-6:
+        return f"exploded at {pos}, physics at {physics_pos}"
+
+def check_snapshot():
+    """
+    A room restored from its snapshot (with a shell in the air) has the
+    same state hash as the room, and both play on the same.
+    """
+    sim = start_room()
+    play_turns(sim, 2)
+    sim.key_up(sim.current_player, pg.K_SPACE)
+    sim.run(20)
+    snapshot = sim.get_snapshot()
+    sim.load_snapshot(snapshot)  # restoring drops the contacts, see Game.send_snapshot
+    restored = server.Simulation(server.DEFAULT_MAP)
+    restored.load_snapshot(server.decode_msg(server.encode_msg(snapshot)))
+    if restored.state_hash() != sim.state_hash():
+        return "the restored state differs"
+    for room in (sim, restored):
+        play_turns(room, 3)
+    if restored.state_hash() != sim.state_hash() or restored.current_tick != sim.current_tick:
+        return "the restored room played differently"
+    sim.stop()
+    restored.stop()
+
+class LockstepPeer:
+    """
+    Simulates a lockstep room from the server's messages like a client
+    does (see client.Game.run_simulation) and compares the state hashes.
+    """
+    def __init__(self, map_index):
+        self.sim = server.Simulation(map_index)
+        self.started = False
+        self.target = 0
+        self.inputs = {}
+        self.hash = None
+        self.hashes_checked = 0
+        self.mismatches = 0
+
+    def receive(self, message):
+        if message['type'] == 'lockstep_snapshot':
+            self.sim.load_snapshot(message['snapshot'])
+            self.started = True
+            self.target = self.sim.current_tick
+            self.inputs = {}
+            self.hash = None
+        elif message['type'] == 'lockstep':
+            for tick, client_id, events in message['inputs']:
+                self.inputs.setdefault(tick, []).append((client_id, events))
+            self.target = message['tick']
+            if 'hash' in message:
+                self.hash = tuple(message['hash'])
+
+    def catch_up(self):
+        sim = self.sim
+        while self.started and sim.current_tick < self.target:
+            for client_id, events in self.inputs.pop(sim.current_tick, []):
+                sim.rx_queue.sync_q.put({'type': 'game_event', 'client_id': client_id, 'events': events})
+            sim.run()
+            if self.hash is not None and self.hash[0] == sim.current_tick:
+                self.hashes_checked += 1
+                self.mismatches += sim.state_hash() != self.hash[1]
+                self.hash = None
+
+def check_lockstep():
+    """
+    Two lockstep peers fed the server's messages agree with the server's
+    state hash over a few turns, and a peer that has gone off notices it.
+    """
+    peers = [LockstepPeer(server.DEFAULT_MAP) for _ in range(2)]
+    def deliver(room_key, message, client_id):
+        for peer in peers:
+            peer.receive(server.decode_msg(server.encode_msg(message)))
+    sim = start_room(send_message_cb=deliver, lockstep=True)
+    def catch_up():
+        for peer in peers:
+            peer.catch_up()
+    play_turns(sim, 4, catch_up)
+    checked = [peer.hashes_checked for peer in peers]
+    if min(checked) == 0 or any(peer.mismatches for peer in peers):
+        return f"hashes checked {checked}, mismatches {[peer.mismatches for peer in peers]}"
+    tank = next(obj for obj in peers[0].sim.objects.as_list() if type(obj) is server.Tank)
+    tank.position += (0, -30)
+    play_turns(sim, 1, catch_up)
+    if not peers[0].mismatches or peers[1].mismatches:
+        return f"a moved tank gave mismatches {[peer.mismatches for peer in peers]}"
+    sim.stop()
+
+def check_walls():
+    """
+    Shells reaching the world walls are removed without exploding, slow and
+    fast ones. A tank pushed into a wall loses, its turn passes on and the
+    room idles again.
+    """
+    sim = start_room()
+    for speed in (600, 3000):
+        shell = fire_shell(sim, (1150, 100), (speed, 0))
+        explosions = []
+        explode = shell.explode
+        shell.explode = lambda space: (explosions.append(shell.position), explode(space))
+        sim.run(2 * server.TICK_RATE)
+        if sim.objects.exists(shell.id) or explosions:
+            return f"a shell at {speed} px/s exploded at {explosions} or stayed at the wall"
+    player = sim.current_player
+    tank = sim.objects.get(player.obj_id)
+    tank.position = (server.WORLD_WIDTH + 35, 500)
+    tank.velocity = (800, 0)
+    idle = sim.run_until(sim.is_idle, 10 * server.TICK_RATE)
+    if not tank.has_lost or sim.current_player is player or not idle:
+        return f"lost {tank.has_lost}, turn passed {sim.current_player is not player}, idle {idle}"
+    sim.stop()
+
+CHECKS = [check_ballistic_flight, check_snapshot, check_lockstep, check_walls]
+
+def run_checks():
+    """
+    Regression checks of the game with headless simulations. Exits with an
+    error if any of them fails.
+    """
+    failed = 0
+    for check in CHECKS:
+        problem = check()
+        print(f"    {check.__name__:<24} {'ok' if problem is None else 'FAILED: ' + problem}")
+        failed += problem is not None
+    if failed:
+        sys.exit(1)
+
+BENCHMARKS = {
+    'crater_rebuild': bench_crater_rebuild,
+    'terrain_colliders': bench_terrain_colliders,
+    'broadphase': bench_broadphase,
+    'threaded_solver': bench_threaded_solver,
+    'simulation': bench_simulation,
+    'checks': run_checks,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+    for name in names:
+        print(f"{name}: {' '.join(BENCHMARKS[name].__doc__.split())}")
+        BENCHMARKS[name]()
@@ -1,10 +1,11 @@
-import asyncio, websockets, json, time, sys, os, traceback
+import asyncio, websockets, json, time, sys, os, traceback, zlib
 from contextlib import suppress
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 import pygame as pg
 from pygame.math import Vector2 as Vector
 import janus
 import random
+import numpy as np
 
 from math import degrees, radians, pi as PI, sin, cos
 
@@ -14,6 +15,8 @@ import pymunk.pygame_util
 from pymunk.vec2d import Vec2d
 from pymunk import BB
 
+import server    # lockstep rooms are simulated with the server's game
+
 ################################################################################
 # SERVER (HOST) ADDRESS (localhost, 192.168.1.14, ...)
 ################################################################################
@@ -45,15 +48,16 @@ MAPS = [{
     "start_positions": [(90, 540)],
     "start_directions": [Vector(1, 0)]
 }]
-MAP = MAPS[0]
+DEFAULT_MAP = 0
 
 #TICK_RATE = 1  # must match with the server
 WORLD_WIDTH, WORLD_HEIGHT = (1200, 900)
 WIDTH, HEIGHT = (1200, 900)
 FPS = 60
 
-if (WORLD_WIDTH, WORLD_HEIGHT) != MAP["world_size"]:
-    print("Warning: Terrain size doesn't match with world size!")
+for m in MAPS:
+    if (WORLD_WIDTH, WORLD_HEIGHT) != m["world_size"]:
+        print(f"Warning: Terrain size of '{m['terrain_file']}' doesn't match with world size!")
 
 PLAYER_SINK = 6
 MAX_HP = 100
@@ -191,6 +195,17 @@ class Game:
         self.joined = False
         self.join_rejected = False
         self.server_tick = 0
+        self.map_index = DEFAULT_MAP    # the server tells which map the room plays
+        self.map = MAPS[DEFAULT_MAP]
+        self.map_version = 0    # last crater applied to the terrain
+
+        # lockstep: the game is simulated here with the inputs the server sends
+        self.lockstep = False
+        self.sim = None         # created from the first snapshot
+        self.sim_target = 0     # tick the server allows simulating up to
+        self.sim_inputs = {}    # tick: [(client_id, events), ...]
+        self.sim_hash = None    # (tick, hash) of the server's state to compare with
+        self.resync_requested = False
 
         self.scr_size = Vector(WIDTH, HEIGHT)
         self.fps = FPS
@@ -229,12 +244,15 @@ class Game:
 
 
     def initialize(self):
+        self.wait_for_join()
+
         self.terrain_surface = pg.Surface((WORLD_WIDTH, WORLD_HEIGHT), flags=pg.SRCALPHA)
 
-        self.map_sprite = pg.image.load(MAP["terrain_file"])
-        #self.background_sprite = pg.image.load(MAP["background_file"])
+        self.map_sprite = pg.image.load(self.map["terrain_file"])
+        #self.background_sprite = pg.image.load(self.map["background_file"])
         map_rect = self.map_sprite.get_rect(bottomleft=(0, WORLD_HEIGHT))
         self.terrain_surface.blit(self.map_sprite, map_rect)
+        self.map_surface = self.terrain_surface.copy()  # the terrain without craters
 
         self.objects.apply_pending_changes()
         for obj_id, obj in self.objects.all():
@@ -246,7 +264,6 @@ class Game:
         self.help_text = self.hud_font.render(f"[LEFT, RIGHT]: Move, [UP, DOWN]: Move barrel, [SPACE]: Shoot, [TAB]: End turn, [R]: Reset tipped over tank, [Q]: Quit.", True, pg.Color('white'))
         self.help_text_rect = self.room_name_text.get_rect().move(5,0)
 
-        self.wait_for_join()
         self.running = True
 
     def run_loop(self):
@@ -301,6 +318,9 @@ class Game:
                     pass
 
     def update(self):
+        if self.sim is not None:
+            self.run_simulation()
+
         for obj_id, obj in self.objects.all():
             obj.update(self.delta)
 
@@ -372,8 +392,11 @@ class Game:
         if self.client_id is not None:
             print(f"Joined. Client ID: {self.client_id}")
 
-    def join(self, client_id):
+    def join(self, client_id, map_index=DEFAULT_MAP, lockstep=False):
         self.client_id = client_id  # get current player's client id
+        self.map_index = map_index
+        self.map = MAPS[map_index]
+        self.lockstep = lockstep
         self.joined = True
 
     def reject_join(self, reason="Unknown"):
@@ -396,47 +419,182 @@ class Game:
 
                 # Object state update
                 if 'objects' in state:
-                    # first, delete objects that were not in the update (left, probably)...
-                    for obj_id, obj in self.objects.all():
-                        if obj_id not in state['objects']:
-                            self.objects.delete(obj_id)
-
-                    # ...then update existing and add new ones
-                    for obj_id, obj_state in state['objects'].items():
-                        if not self.objects.exists(obj_id):
-                            # create new object of type
-                            obj = None
-                            if obj_state['class'] == 'Tank':
-                                obj = Tank(obj_state['name'], obj_state['position'], obj_state['model'])
-                                obj.owner_id = obj_state['owner_id']
-                                obj.owned_by_player = obj_state['owner_id'] == self.client_id
-                                obj.update_state(obj_state)
-                            elif obj_state['class'] == 'Projectile':
-                                obj = Projectile(obj_state['position'])
-                                obj.owner_id = obj_state['owner_id']
-                                obj.owned_by_player = obj_state['owner_id'] == self.client_id
-                                obj.update_state(obj_state)
-                            else:
-                                raise Exception("Unknown class received!")
-
-                            self.add_obj_with_id(obj_id, obj)
-                        else:
-                            # update existing object
-                            obj = self.objects.get(obj_id)
-                            obj.update_state(obj_state)
-
-                        # save the user's tank for easier access
-                        if hasattr(obj, 'owner_id') and obj.owner_id == self.client_id:
-                            self.my_tank = obj
+                    self.update_objects(state['objects'])
 
                 if 'map_update' in state:
-                    for utype, udata in state['map_update']:
-                        if utype == 'CIRCLE':
-                            upos, urad = udata
-                            update_surf = pg.Surface((2*urad, 2*urad), flags=pg.SRCALPHA)
-                            update_surf.fill(pg.Color('white'))
-                            pg.draw.circle( update_surf, (0,0,0,0), (urad,urad), urad)
-                            self.terrain_surface.blit( update_surf, update_surf.get_rect(center=(upos)), special_flags=pg.BLEND_RGBA_MULT )
+                    self.update_map(state['map_update'])
+                    self.send_message({'type': 'map_ack', 'version': self.map_version})
+
+                # compare the terrain to the server's once up to the same version
+                if 'map_checksums' in state and state['map_version'] == self.map_version:
+                    bad_chunks = [i for i, (checksum, own) in enumerate(zip(state['map_checksums'], self.terrain_checksums())) if checksum != own]
+                    if bad_chunks:
+                        self.send_message({'type': 'map_repair', 'chunks': bad_chunks})
+
+            # terrain chunks that differ from the map, sent after joining or to repair the terrain
+            elif message['type'] == 'map_snapshot':
+                for x0, y0, x1, y1, rows in message['chunks']:
+                    solid = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+                    for y, spans in enumerate(rows):
+                        for start, end in zip(spans[::2], spans[1::2]):
+                            solid[start:end, y] = True
+                    self.restore_chunk((x0, y0, x1, y1), solid)
+
+                if message['version'] is not None:
+                    self.map_version = message['version']
+                    self.send_message({'type': 'map_ack', 'version': self.map_version})
+
+            # lockstep: inputs to simulate and how far
+            elif message['type'] == 'lockstep':
+                if self.sim is None and not self.resync_requested:
+                    # the snapshot went by before joining
+                    self.send_message({'type': 'resync'})
+                    self.resync_requested = True
+                for tick, client_id, events in message['inputs']:
+                    self.sim_inputs.setdefault(tick, []).append((client_id, events))
+                self.sim_target = message['tick']
+                if 'hash' in message:
+                    self.sim_hash = tuple(message['hash'])
+
+            # lockstep: the whole game to (re)start the simulation from
+            elif message['type'] == 'lockstep_snapshot':
+                self.load_snapshot(message['snapshot'])
+
+    def update_objects(self, objects):
+        # first, delete objects that were not in the update (left, probably)...
+        for obj_id, obj in self.objects.all():
+            if obj_id not in objects:
+                self.objects.delete(obj_id)
+
+        # ...then update existing and add new ones
+        for obj_id, obj_state in objects.items():
+            if not self.objects.exists(obj_id):
+                # create new object of type
+                obj = None
+                if obj_state['class'] == 'Tank':
+                    obj = Tank(obj_state['name'], obj_state['position'], obj_state['model'])
+                    obj.owner_id = obj_state['owner_id']
+                    obj.owned_by_player = obj_state['owner_id'] == self.client_id
+                    obj.update_state(obj_state)
+                elif obj_state['class'] == 'Projectile':
+                    obj = Projectile(obj_state['position'])
+                    obj.owner_id = obj_state['owner_id']
+                    obj.owned_by_player = obj_state['owner_id'] == self.client_id
+                    obj.update_state(obj_state)
+                else:
+                    raise Exception("Unknown class received!")
+
+                self.add_obj_with_id(obj_id, obj)
+            else:
+                # update existing object
+                obj = self.objects.get(obj_id)
+                obj.update_state(obj_state)
+
+            # save the user's tank for easier access
+            if hasattr(obj, 'owner_id') and obj.owner_id == self.client_id:
+                self.my_tank = obj
+
+    def update_map(self, map_update):
+        # craters are re-sent until acknowledged, skip the ones already applied
+        for utype, udata, version in map_update:
+            if version <= self.map_version:
+                continue
+            self.map_version = version
+            if utype == 'CIRCLE':
+                upos, urad = udata
+                self.erase_circle(upos, urad)
+
+    def restore_chunk(self, box, solid):
+        """
+        Redraws a terrain chunk from the map without craters, clearing what
+        isn't solid anymore.
+        """
+        x0, y0, x1, y1 = box
+        chunk_rect = pg.Rect(x0, y0, x1 - x0, y1 - y0)
+        self.terrain_surface.fill((0, 0, 0, 0), chunk_rect)
+        self.terrain_surface.blit(self.map_surface, chunk_rect, chunk_rect, special_flags=pg.BLEND_RGBA_ADD)
+        alpha = pg.surfarray.pixels_alpha(self.terrain_surface)
+        alpha[x0:x1, y0:y1][~solid] = 0
+        del alpha  # unlock the surface
+
+    def load_snapshot(self, snapshot):
+        """
+        (Re)starts the lockstep simulation from the server's snapshot. The
+        inputs received so far are in it.
+        """
+        if self.sim is None:
+            self.sim = server.Simulation(self.map_index)
+        self.sim.load_snapshot(snapshot)
+        self.sim_target = self.sim.current_tick
+        self.sim_inputs = {}
+        self.sim_hash = None
+        self.resync_requested = False
+
+        # the terrain is redrawn where it differs from the map
+        mask = self.sim.terrain.mask
+        for box in mask.changed_boxes(self.sim.assets.terrain_mask, server.SNAPSHOT_CHUNK_SIZE):
+            self.restore_chunk(box, mask.region(*box))
+        self.map_version = self.sim.craters.version
+        self.update_objects({str(obj_id): state for obj_id, state in self.sim.get_game_state()['objects'].items()})
+
+    def run_simulation(self):
+        """
+        Steps the lockstep simulation up to the tick the server allows, with
+        the players' inputs at the ticks the server handled them, and shows
+        its state. A state that differs from the server's is replaced with a
+        snapshot.
+        """
+        sim = self.sim
+        while sim.current_tick < self.sim_target:
+            for client_id, events in self.sim_inputs.pop(sim.current_tick, []):
+                sim.rx_queue.sync_q.put({'type': 'game_event', 'client_id': client_id, 'events': events})
+            sim.run()
+            if self.sim_hash is not None and self.sim_hash[0] == sim.current_tick:
+                if sim.state_hash() != self.sim_hash[1] and not self.resync_requested:
+                    print(f"Warning: out of sync with the server at tick {sim.current_tick}, requesting a snapshot.")
+                    self.send_message({'type': 'resync'})
+                    self.resync_requested = True
+                self.sim_hash = None
+
+        state = sim.get_game_state()
+        self.update_objects({str(obj_id): obj_state for obj_id, obj_state in state['objects'].items()})
+        if sim.craters.base > self.map_version:
+            # too many craters at once for the journal, redraw the changed chunks
+            mask = sim.terrain.mask
+            for box in mask.changed_boxes(sim.assets.terrain_mask, server.SNAPSHOT_CHUNK_SIZE):
+                self.restore_chunk(box, mask.region(*box))
+            self.map_version = sim.craters.base
+        self.update_map(sim.craters.since(self.map_version))
+
+    def erase_circle(self, pos, radius):
+        """
+        Erases the terrain pixels whose center is inside the circle, the same
+        pixels as the server does.
+        """
+        x0, y0 = max(int(pos[0] - radius), 0), max(int(pos[1] - radius), 0)
+        x1, y1 = min(int(pos[0] + radius) + 1, WORLD_WIDTH), min(int(pos[1] + radius) + 1, WORLD_HEIGHT)
+        if x0 >= x1 or y0 >= y1:
+            return
+        xs = np.arange(x0, x1)[:, None] + 0.5
+        ys = np.arange(y0, y1)[None, :] + 0.5
+        alpha = pg.surfarray.pixels_alpha(self.terrain_surface)
+        alpha[x0:x1, y0:y1][(xs - pos[0]) ** 2 + (ys - pos[1]) ** 2 <= radius ** 2] = 0
+        del alpha  # unlock the surface
+
+    def terrain_checksums(self):
+        """
+        Checksums of the terrain chunks, computed like the server does from its
+        bit-packed terrain mask.
+        """
+        alpha = pg.surfarray.pixels_alpha(self.terrain_surface)
+        solid = alpha > server.MARCH_THRESHOLD
+        del alpha  # unlock the surface
+        checksums = []
+        for y0 in range(0, WORLD_HEIGHT, server.SNAPSHOT_CHUNK_SIZE):
+            for x0 in range(0, WORLD_WIDTH, server.SNAPSHOT_CHUNK_SIZE):
+                chunk = solid[x0:x0 + server.SNAPSHOT_CHUNK_SIZE, y0:y0 + server.SNAPSHOT_CHUNK_SIZE]
+                checksums.append(zlib.crc32(np.packbits(chunk, axis=1).tobytes()))
+        return checksums
 
     def send_event(self, event):
         self.send_message({
@@ -724,6 +882,7 @@ class Projectile(GameObject):
         self.position = Vec2d(*position)
         self.owner_id = None
         self.exploded = False
+        self.velocity = Vec2d(0, 0)
 
     def initialize(self):
         super().initialize()
@@ -731,6 +890,10 @@ class Projectile(GameObject):
 
     def update(self, delta):
         super().update(delta)
+        # the shell flies along its parabola between the server's updates
+        if not self.exploded:
+            self.position += delta * self.velocity
+            self.velocity += delta * Vec2d(*server.GRAVITY)
 
     def draw(self, scr, hud):
         super().draw(scr, hud)
@@ -747,6 +910,7 @@ class Projectile(GameObject):
     def update_state(self, state):
         super().update_state(state)
         self.exploded = bool(state['exploded'])
+        self.velocity = Vec2d(*state['velocity'])
 
 class GameClient:
     def __init__(self, host, port):
@@ -758,14 +922,16 @@ class GameClient:
         # client info
         self.player_name = None
         self.client_id = None
+        self.map_index = None   # map of a new room (None = server default)
         
         self.game = None
         self.running = False
         self.recv_ready = False
 
-    def set_connection_info(self, room_key, player_name):
+    def set_connection_info(self, room_key, player_name, map_index=None):
         self.room_key = room_key
         self.player_name = player_name
+        self.map_index = map_index
 
     def run(self):
         self.running = True
@@ -845,7 +1011,10 @@ class GameClient:
             pass
 
         # join request will be sent as soon as the threads are ready
-        self.send_message({'type': 'join', 'room': self.room_key, 'player_name': self.player_name})
+        join_message = {'type': 'join', 'room': self.room_key, 'player_name': self.player_name}
+        if self.map_index is not None:
+            join_message['map'] = self.map_index  # only used if the room is created
+        self.send_message(join_message)
         self.game.initialize()
         try:
             while self.running and self.game.running:
@@ -869,7 +1038,7 @@ class GameClient:
                         await self.game.rx_queue.async_q.put(message)
                     else:  # wait for join
                         if message['type'] == 'joined':
-                            self.game.join(message['client_id'])
+                            self.game.join(message['client_id'], message.get('map', DEFAULT_MAP), message.get('lockstep', False))
                         elif message['type'] == 'join-rejected':
                             self.game.reject_join(message['reason'])
                             break
@@ -910,10 +1079,12 @@ if __name__ == "__main__":
     print("-----------------")
     room_key = input("Room: ")
     player_name = input("Nickname: ")
+    map_choice = input(f"Map for a new room (1-{len(MAPS)}, empty for default): ")
+    map_index = int(map_choice) - 1 if map_choice.isdigit() and 1 <= int(map_choice) <= len(MAPS) else None
 
     if len(room_key) == 0 or len(room_key) == 0:
         print("Invalid nickname or room!")
     else:
         client = GameClient(SERVER_ADDR, SERVER_PORT)
-        client.set_connection_info(room_key, player_name)
+        client.set_connection_info(room_key, player_name, map_index)
         client.run()
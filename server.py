@@ -7,14 +7,17 @@ Server:
         3. Send thread (producer). Waits messages to appear to the send buffer
            and sends them to the client(s).
 '''
-import asyncio, websockets, json, time, sys, os, traceback
+import asyncio, websockets, json, time, sys, os, traceback, hashlib, threading
+import collections, multiprocessing, zlib, queue, base64
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import suppress
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 import pygame as pg
 from pygame.math import Vector2 as Vector
-from math import pi as PI, sin, cos, degrees, radians
+from math import pi as PI, sin, cos, degrees, radians, sqrt, inf
 import janus
 import random
+import numpy as np
 
 import pymunk as pm
 import pymunk.autogeometry
@@ -46,24 +49,39 @@ MAPS = [{
     "background_file": "img/background_sky.png",
     "max_players": 2,
     "start_positions": [(90, 540), (1110, 540), (550, 230)],
-    "start_directions": [Vector(1, 0), -Vector(1, 0), Vector(1, 0)]
+    "start_directions": [Vector(1, 0), -Vector(1, 0), Vector(1, 0)],
+    "broadphase": 'bbtree',  # faster in 'python benchmark.py broadphase'
+    "solver": 'single'   # 2 tanks and a few shells, the threads wouldn't pay off
 }, {
     "world_size": (1200, 900),
     "terrain_file": "img/map-obstacle-course.png",
     "background_file": "img/background_sky.png",
     "max_players": 1,
     "start_positions": [(90, 540)],
-    "start_directions": [Vector(1, 0)]
+    "start_directions": [Vector(1, 0)],
+    "broadphase": 'bbtree',
+    "solver": 'single'
 }]
-MAP = MAPS[0]
+DEFAULT_MAP = 0
 
 # Physics: 120 FPS, updates: 30 FPS
 TICK_RATE = 120
 FRAMES_PER_UPDATE = 4 # send update every 4th loop = 30 UPS
+IDLE_TICK_RATE = 10   # loops per second while nothing moves (no physics, an update every loop)
+MAX_CATCHUP_STEPS = 8 # physics steps per loop at most when behind (beyond that the game slows down)
+GRAVITY = (0, 980)    # px/s^2
+SLEEP_TIME_THRESHOLD = 0.5  # s, resting bodies fall asleep after this
+SOLVER = 'single'     # 'single', 'threaded' or 'auto' = threaded from THREADED_SOLVER_OBJECTS objects on (maps can override)
+SOLVER_THREADS = 2    # pymunk's threaded solver runs on 2 threads at most
+THREADED_SOLVER_OBJECTS = 200  # see 'python benchmark.py threaded_solver' on the server machine
+BALLISTIC_STEPS = 12  # steps a shell flies outside the physics at most before its surroundings are checked again
+LOCKSTEP = False      # rooms send the players' inputs instead of the game state, every client simulates the game
+LOCKSTEP_HASH_TICKS = TICK_RATE  # ticks between the state hashes the lockstep clients compare to their own
 WORLD_WIDTH, WORLD_HEIGHT = (1200, 900)
 
-if (WORLD_WIDTH, WORLD_HEIGHT) != MAP["world_size"]:
-    print("Warning: Terrain size doesn't match with world size!")
+for m in MAPS:
+    if (WORLD_WIDTH, WORLD_HEIGHT) != m["world_size"]:
+        print(f"Warning: Terrain size of '{m['terrain_file']}' doesn't match with world size!")
 
 PLAYER_SINK = 6
 MAX_HP = 100
@@ -73,6 +91,18 @@ MOVEMENT_AP_COST    = 20
 SHOOT_AP_COST       = 25
 RESET_AP_COST       = 25
 
+# Shape filter categories and what each one collides with, also used in the
+# space queries. A player's tank and shells share a group (owner id + 1), a
+# shell can't hit the tank that shot it.
+TERRAIN_CATEGORY    = 0b0001
+WALL_CATEGORY       = 0b0010
+TANK_CATEGORY       = 0b0100
+PROJECTILE_CATEGORY = 0b1000
+TERRAIN_MASK        = TANK_CATEGORY | PROJECTILE_CATEGORY  # the static shapes are only hit by moving ones
+WALL_MASK           = TANK_CATEGORY | PROJECTILE_CATEGORY
+TANK_MASK           = TERRAIN_CATEGORY | WALL_CATEGORY | TANK_CATEGORY | PROJECTILE_CATEGORY
+PROJECTILE_MASK     = TERRAIN_CATEGORY | WALL_CATEGORY | TANK_CATEGORY | PROJECTILE_CATEGORY
+
 TANK_MODELS = [
     "tank1_blue",
     "tank1_red",
@@ -81,50 +111,707 @@ TANK_MODELS = [
     #"tank2_black",
 ]
 
-def generate_geometry(surface, space):
+# Terrain collision map: marching squares grid and simplification
+MARCH_SAMPLES = (180, 180)  # samples over the whole (default-sized) world (x, y)
+MARCH_THRESHOLD = 90
+SIMPLIFY_TOLERANCE = 1.0
+MARCH_STEP = ((WORLD_WIDTH - 1) / (MARCH_SAMPLES[0] - 1), (WORLD_HEIGHT - 1) / (MARCH_SAMPLES[1] - 1))
+TERRAIN_CHUNK_SIZE = 150    # px, the terrain geometry is generated per chunk
+TERRAIN_COLLIDER = 'segments'   # terrain shapes: 'segments' along the contours or convex 'polys' filling the terrain
+BROADPHASE = 'bbtree'       # 'bbtree' or 'spatial_hash' sized from the terrain (maps can override, see benchmark.py)
+TERRAIN_CACHE_DIR = 'cache' # precompiled terrain geometry
+TERRAIN_WORKERS = 2         # processes rebuilding terrain geometry (0 = rebuild in the game thread)
+SDF_CELL = 4                # px per cell of the terrain distance field
+SDF_MAX_DIST = 64           # px, distances are clamped to this
+CRATER_JOURNAL_SIZE = 64    # craters kept for resending, clients further behind get a snapshot
+SNAPSHOT_CHUNK_SIZE = 120   # px, terrain snapshots and checksums are per chunk (multiple of 8)
+SNAPSHOT_CHUNKS_PER_MESSAGE = 8
+CHECKSUM_UPDATES = 30       # terrain chunk checksums are sent every 30th update (1 s)
+
+def terrain_cache_file(terrain_file, world_size, collider=TERRAIN_COLLIDER):
+    """
+    Path of the precompiled geometry of a terrain image in a world of the
+    map's size (the image is placed at its bottom left). The name is a hash
+    of the image and of everything else the generated geometry depends on.
+    """
+    digest = hashlib.sha1()
+    with open(terrain_file, 'rb') as f:
+        digest.update(f.read())
+    params = ('mask', collider, tuple(world_size), WORLD_WIDTH, WORLD_HEIGHT, MARCH_SAMPLES, MARCH_THRESHOLD, SIMPLIFY_TOLERANCE, TERRAIN_CHUNK_SIZE)
+    digest.update(repr(params).encode())
+    return os.path.join(TERRAIN_CACHE_DIR, f"terrain-{digest.hexdigest()}.json")
+
+# Segments traced for each marching squares cell case, as in Chipmunk's
+# cpMarchCellSoft. The edge points are: left (L), top (T), right (R) and
+# bottom (B) edge of the cell, top meaning the smaller y.
+MARCH_CASES = {
+    0x1: [('L', 'T')],
+    0x2: [('T', 'R')],
+    0x3: [('L', 'R')],
+    0x4: [('B', 'L')],
+    0x5: [('B', 'T')],
+    0x6: [('T', 'R'), ('B', 'L')],
+    0x7: [('B', 'R')],
+    0x8: [('R', 'B')],
+    0x9: [('L', 'T'), ('R', 'B')],
+    0xA: [('T', 'B')],
+    0xB: [('L', 'B')],
+    0xC: [('R', 'L')],
+    0xD: [('R', 'T')],
+    0xE: [('T', 'L')],
+}
+
+def march_grid(samples, xs, ys, threshold):
+    """
+    Vectorized version of pm.autogeometry.march_soft for an already sampled
+    grid (samples indexed [i, j] at points (xs[i], ys[j])). Returns a
+    PolylineSet like march_soft does.
+    """
+    a, b = samples[:-1, :-1], samples[1:, :-1]
+    c, d = samples[:-1, 1:], samples[1:, 1:]
+    x0, x1 = xs[:-1, None], xs[1:, None]
+    y0, y1 = ys[None, :-1], ys[None, 1:]
+    cases = (a > threshold) | (b > threshold) << 1 | (c > threshold) << 2 | (d > threshold) << 3
+
+    def midlerp(p0, p1, s0, s1):
+        return p0 + (p1 - p0) * (threshold - s0) / (s1 - s0)
+
+    line_set = pm.autogeometry.PolylineSet()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edges = {
+            'L': np.broadcast_arrays(x0, midlerp(y0, y1, a, c)),
+            'T': np.broadcast_arrays(midlerp(x0, x1, a, b), y0),
+            'R': np.broadcast_arrays(x1, midlerp(y0, y1, b, d)),
+            'B': np.broadcast_arrays(midlerp(x0, x1, c, d), y1),
+        }
+
+    segments = []
+    for case, case_segments in MARCH_CASES.items():
+        cells = cases == case
+        if not cells.any():
+            continue
+        ci, cj = np.nonzero(cells)
+        order = cj * cells.shape[0] + ci  # chipmunk marches row by row
+        for start, end in case_segments:
+            v0 = np.column_stack([edges[start][0][cells], edges[start][1][cells]])
+            v1 = np.column_stack([edges[end][0][cells], edges[end][1][cells]])
+            segments.append((order, v0, v1))
+
+    if not segments:
+        return line_set
+    order = np.concatenate([o for o, _, _ in segments])
+    v0 = np.concatenate([v for _, v, _ in segments])
+    v1 = np.concatenate([v for _, _, v in segments])
+    for k in np.argsort(order, kind='stable'):
+        if (v0[k] != v1[k]).any():
+            line_set.collect_segment(tuple(v1[k]), tuple(v0[k]))
+    return line_set
+
+def march_chunk(samples, xs, ys):
+    """
+    Traces and simplifies the contour of a sampled grid region. Takes and
+    returns plain data, so it can be run in a worker process.
+    """
+    line_set = march_grid(samples, xs, ys, MARCH_THRESHOLD)
+    return [[tuple(p) for p in pm.autogeometry.simplify_curves(polyline, SIMPLIFY_TOLERANCE)] for polyline in line_set]
+
+def polygon_area(polyline):
+    """
+    Signed area of a closed polyline. Marching gives the outlines of solid
+    terrain a positive area and the outlines of holes a negative one.
+    """
+    points = np.asarray(polyline, dtype=float)
+    x, y = points[:, 0], points[:, 1]
+    return (x[:-1] * y[1:] - x[1:] * y[:-1]).sum() / 2
+
+def decompose_chunk(samples, xs, ys):
+    """
+    Fills the solid terrain of a sampled grid region with convex polygons.
+    The region is padded with empty samples on its border, so every piece of
+    terrain gets a closed outline that follows the region border. Outlines
+    with holes can't be decomposed, so such regions are split in two
+    (sharing the samples of the cut) until the holes are gone. Takes and
+    returns plain data, so it can be run in a worker process.
+    """
+    padded = np.pad(samples, 1)
+    # the padding lies on the border, so the outlines run exactly along it
+    padded_xs = np.concatenate([xs[:1], xs, xs[-1:]])
+    padded_ys = np.concatenate([ys[:1], ys, ys[-1:]])
+    outlines = [list(line) for line in march_grid(padded, padded_xs, padded_ys, MARCH_THRESHOLD)]
+
+    if any(polygon_area(line) < 0 for line in outlines) and max(samples.shape) > 2:
+        if samples.shape[0] >= samples.shape[1]:
+            k = samples.shape[0] // 2
+            return decompose_chunk(samples[:k + 1], xs[:k + 1], ys) + decompose_chunk(samples[k:], xs[k:], ys)
+        k = samples.shape[1] // 2
+        return decompose_chunk(samples[:, :k + 1], xs, ys[:k + 1]) + decompose_chunk(samples[:, k:], xs, ys[k:])
+
+    polygons = []
+    for line in outlines:
+        if polygon_area(line) <= 0:
+            continue
+        line = pm.autogeometry.simplify_curves(line, SIMPLIFY_TOLERANCE)
+        for hull in pm.autogeometry.convex_decomposition(line, SIMPLIFY_TOLERANCE):
+            if abs(polygon_area(hull)) > 0.5:   # skip slivers
+                polygons.append([tuple(p) for p in hull[:-1]])
+    return polygons
+
+_terrain_executor = None
+_terrain_executor_lock = threading.Lock()
+
+def get_terrain_executor():
+    """
+    Returns the process pool shared by all rooms for rebuilding terrain
+    geometry, or None if rebuilds are done in the game thread.
+    """
+    global _terrain_executor
+    with _terrain_executor_lock:
+        if TERRAIN_WORKERS and _terrain_executor is None:
+            # the server runs several threads, don't fork it
+            context = multiprocessing.get_context('spawn')
+            _terrain_executor = ProcessPoolExecutor(TERRAIN_WORKERS, mp_context=context)
+        return _terrain_executor
+
+def shutdown_terrain_executor():
+    global _terrain_executor
+    with _terrain_executor_lock:
+        if _terrain_executor is not None:
+            _terrain_executor.shutdown(wait=False, cancel_futures=True)
+            _terrain_executor = None
+
+def distance_transform(feature, max_cells):
+    """
+    Euclidean distance (in cells, clamped to max_cells + 1) from every cell
+    of the array to the nearest feature cell. A vertical pass finds the
+    nearest feature in each column, a horizontal pass over the neighbouring
+    columns then gives the exact distance within the clamp.
+    """
+    width, height = feature.shape
+    far = max_cells + 1
+    rows = np.arange(height)[None, :]
+    above = np.maximum.accumulate(np.where(feature, rows, -height - far), axis=1)
+    below = np.minimum.accumulate(np.where(feature, rows, 2 * height + far)[:, ::-1], axis=1)[:, ::-1]
+    column_dist = np.minimum(rows - above, below - rows).clip(max=far).astype(np.float32)
+
+    column_dist2 = column_dist ** 2
+    best = np.full(feature.shape, float(far ** 2), dtype=np.float32)
+    for dx in range(-min(max_cells, width - 1), min(max_cells, width - 1) + 1):
+        if dx >= 0:
+            np.minimum(best[:width - dx], column_dist2[dx:] + dx * dx, out=best[:width - dx])
+        else:
+            np.minimum(best[-dx:], column_dist2[:width + dx] + dx * dx, out=best[-dx:])
+    return np.sqrt(best)
+
+class TerrainMask:
+    """
+    Solid/empty state of every terrain pixel, bit-packed along y (1 bit per
+    pixel, 8 pixels per byte). Indexed [x, y] like pg.surfarray.
+    """
+    def __init__(self, bits, size):
+        self.bits = bits    # uint8 array (width, ceil(height / 8))
+        self.size = size    # in pixels
+
+    @classmethod
+    def from_surface(cls, surface):
+        """
+        A pixel is solid if its alpha is above MARCH_THRESHOLD.
+        """
+        solid = pg.surfarray.array_alpha(surface) > MARCH_THRESHOLD
+        return cls(np.packbits(solid, axis=1), surface.get_size())
+
+    def copy(self):
+        return TerrainMask(self.bits.copy(), self.size)
+
+    def at(self, xs, ys):
+        """
+        Solid state of the pixels at the (broadcast) index arrays.
+        """
+        return (self.bits[xs, ys >> 3] >> (7 - (ys & 7)) & 1).astype(bool)
+
+    def region(self, x0, y0, x1, y1):
+        """
+        Solid state of the pixels in the box as a bool array.
+        """
+        b0, b1 = y0 >> 3, -(-y1 >> 3)
+        solid = np.unpackbits(self.bits[x0:x1, b0:b1], axis=1)
+        return solid[:, y0 - 8 * b0:y1 - 8 * b0].astype(bool)
+
+    def circle(self, pos, radius):
+        """
+        Box (x0, y0, x1, y1) around a circle, clipped to the mask, and which
+        of its pixels are inside the circle. None if the box is empty.
+        """
+        width, height = self.size
+        x0, y0 = max(int(pos[0] - radius), 0), max(int(pos[1] - radius), 0)
+        x1, y1 = min(int(pos[0] + radius) + 1, width), min(int(pos[1] + radius) + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        xs = np.arange(x0, x1)[:, None] + 0.5
+        ys = np.arange(y0, y1)[None, :] + 0.5
+        return (x0, y0, x1, y1), (xs - pos[0]) ** 2 + (ys - pos[1]) ** 2 <= radius ** 2
+
+    def any_in_circle(self, pos, radius):
+        circle = self.circle(pos, radius)
+        return circle is not None and bool((self.region(*circle[0]) & circle[1]).any())
+
+    def erase_circle(self, pos, radius):
+        """
+        Clears the pixels inside the circle. Returns the changed box as a
+        pg.Rect (empty if outside the mask).
+        """
+        circle = self.circle(pos, radius)
+        if circle is None:
+            return pg.Rect(0, 0, 0, 0)
+        (x0, y0, x1, y1), inside = circle
+        # whole bytes are unpacked and packed back
+        b0, b1 = y0 >> 3, -(-y1 >> 3)
+        solid = np.unpackbits(self.bits[x0:x1, b0:b1], axis=1)
+        solid[:, y0 - 8 * b0:y1 - 8 * b0][inside] = 0
+        self.bits[x0:x1, b0:b1] = np.packbits(solid, axis=1)
+        return pg.Rect(x0, y0, x1 - x0, y1 - y0)
+
+    def chunk_boxes(self, chunk_size):
+        """
+        Boxes (x0, y0, x1, y1) of the chunks of chunk_size pixels (a multiple
+        of 8), row by row.
+        """
+        width, height = self.size
+        return [(x0, y0, min(x0 + chunk_size, width), min(y0 + chunk_size, height))
+                for y0 in range(0, height, chunk_size) for x0 in range(0, width, chunk_size)]
+
+    def chunk_bytes(self, box):
+        x0, y0, x1, y1 = box
+        return self.bits[x0:x1, y0 >> 3:-(-y1 >> 3)]
+
+    def checksum(self, box):
+        """
+        CRC-32 of the packed bits of a chunk box. The client packs its own
+        terrain the same way to compare.
+        """
+        return zlib.crc32(self.chunk_bytes(box).tobytes())
+
+    def changed_boxes(self, other, chunk_size):
+        """
+        Boxes of the chunks that differ from the other mask.
+        """
+        if self.bits is other.bits:
+            return []
+        return [box for box in self.chunk_boxes(chunk_size) if (self.chunk_bytes(box) != other.chunk_bytes(box)).any()]
+
+    def encode_rows(self, box):
+        """
+        Run-length encodes the box row by row. Each row is a flat list of the
+        solid spans [start, end, start, end, ...] as x offsets from the left of
+        the box.
+        """
+        x0, y0, x1, y1 = box
+        rows = self.region(*box).T.astype(np.int8)
+        edges = np.diff(np.pad(rows, ((0, 0), (1, 1))), axis=1)
+        row_index, offsets = np.nonzero(edges)
+        ends = np.searchsorted(row_index, np.arange(len(rows)), side='right')
+        starts = np.concatenate([[0], ends[:-1]])
+        return [offsets[s:e].tolist() for s, e in zip(starts, ends)]
+
+class TerrainSDF:
+    """
+    Signed distance field of the terrain with one cell per SDF_CELL pixels:
+    negative inside terrain, positive in the air and clamped to SDF_MAX_DIST.
+    Answered with a single array lookup.
     """
-    Used by the game engine to generate a terrain based on an image (surface).
+    def __init__(self, solid_cells, size):
+        self.solid_cells = solid_cells  # func((x0, y0, x1, y1)) -> solid cells of the box
+        self.size = size                # in cells
+        self.distance = np.empty(size, dtype=np.float32)
+        self.refresh((0, 0) + size)
+
+    def copy(self, solid_cells):
+        sdf = TerrainSDF.__new__(TerrainSDF)
+        sdf.solid_cells = solid_cells
+        sdf.size = self.size
+        sdf.distance = self.distance.copy()
+        return sdf
+
+    def refresh(self, box):
+        """
+        Recomputes the cells of the box (x0, y0, x1, y1, in cells) after the
+        terrain inside it has changed. Cells further than SDF_MAX_DIST from
+        the box keep their value.
+        """
+        reach = SDF_MAX_DIST // SDF_CELL
+        w, h = self.size
+        x0, y0, x1, y1 = max(box[0] - reach, 0), max(box[1] - reach, 0), min(box[2] + reach, w), min(box[3] + reach, h)
+        # the distances of those cells depend on the cells up to reach further
+        ox0, oy0, ox1, oy1 = max(x0 - reach, 0), max(y0 - reach, 0), min(x1 + reach, w), min(y1 + reach, h)
+        solid = self.solid_cells((ox0, oy0, ox1, oy1))
+
+        to_solid = distance_transform(solid, reach)
+        to_air = distance_transform(~solid, reach)
+        # distances are between cell centers, the surface is half a cell closer
+        distance = np.where(solid, 0.5 - to_air, to_solid - 0.5) * SDF_CELL
+        inner = (slice(x0 - ox0, x1 - ox0), slice(y0 - oy0, y1 - oy0))
+        self.distance[x0:x1, y0:y1] = distance[inner].clip(-SDF_MAX_DIST, SDF_MAX_DIST)
+
+    def cell(self, pos):
+        cx, cy = int(pos[0] // SDF_CELL), int(pos[1] // SDF_CELL)
+        if 0 <= cx < self.size[0] and 0 <= cy < self.size[1]:
+            return cx, cy
+        return None
+
+    def distance_at(self, pos):
+        cell = self.cell(pos)
+        return float(self.distance[cell]) if cell else SDF_MAX_DIST
+
+class TerrainChunk:
+    def __init__(self, region, bb):
+        self.region = region                            # grid region (i0, j0, i1, j1)
+        self.bb = bb                                    # area covered in the world
+        self.body = pm.Body(body_type=pm.Body.STATIC)   # holds the chunk's segments
+        self.shapes = []
+        self.dirty = True
+        self.version = 0                                # incremented on every change
+        self.rebuilding = False                         # a worker is marching the chunk
+
+class Terrain:
     """
-    for s in space.shapes:
-        if hasattr(s, "generated") and s.generated:
-            space.remove(s)
+    Collision geometry generated from the terrain mask. The world is split in
+    chunks of about TERRAIN_CHUNK_SIZE pixels which are marched separately,
+    so erasing a piece of terrain only rebuilds the chunks it touches.
+    Neighbouring chunks share the samples on their common border, which
+    makes the contours meet exactly at the seams.
+
+    The collider is either 'segments', thin segments along the contours, or
+    'polys', convex polygons filling the solid terrain (fewer and thicker
+    shapes, which are harder to tunnel through).
+
+    With an executor the chunks are marched in the background. The new shapes
+    of all chunks dirtied together are swapped into the space at once by
+    swap_finished(), which the game calls between physics steps. Until then
+    the old geometry stays in place.
+    """
+    def __init__(self, mask, space, shared=False, executor=None, sdf=None, collider=TERRAIN_COLLIDER):
+        if collider not in ('segments', 'polys'):
+            raise ValueError(f"Unknown terrain collider '{collider}'")
+        self.collider = collider
+        self.trace = march_chunk if collider == 'segments' else decompose_chunk
+        self.mask = mask
+        self.shared = shared  # the mask (and sdf) is shared with other rooms, copy it before modifying
+        self.space = space
+        self.executor = executor
+        self.batches = collections.deque()  # pending background rebuilds, oldest first
+
+        width, height = mask.size
+        self.step = MARCH_STEP
+        self.samples = (round((width - 1) / self.step[0]) + 1, round((height - 1) / self.step[1]) + 1)
+
+        bounds_x = self.chunk_bounds(self.samples[0], self.step[0])
+        bounds_y = self.chunk_bounds(self.samples[1], self.step[1])
+        self.chunks = []
+        for j0, j1 in zip(bounds_y, bounds_y[1:]):
+            for i0, i1 in zip(bounds_x, bounds_x[1:]):
+                region = (i0, j0, i1, j1)
+                self.chunks.append(TerrainChunk(region, self.grid_bb(region)))
+        self.space.add(*[chunk.body for chunk in self.chunks])
+
+        if sdf is None:
+            sdf = TerrainSDF(self.solid_cells, (-(-width // SDF_CELL), -(-height // SDF_CELL)))
+        self.sdf = sdf
+
+        # checksums of the mask chunks, updated as craters are erased
+        self.checksum_boxes = mask.chunk_boxes(SNAPSHOT_CHUNK_SIZE)
+        self.checksums = [mask.checksum(box) for box in self.checksum_boxes]
+
+    @staticmethod
+    def chunk_bounds(samples, step):
+        """
+        Grid indices of the chunk borders along one axis.
+        """
+        cells = TERRAIN_CHUNK_SIZE / step
+        return sorted({min(round(k * cells), samples - 1) for k in range(int((samples - 1) / cells) + 2)})
 
-    def sample_func(point):
+    def grid_region(self, rect):
+        """
+        Returns the region (i0, j0, i1, j1) of grid samples taken from inside
+        the given pg.Rect.
+        """
+        step_x, step_y = self.step
+        i0 = max(int(rect.left // step_x), 0)
+        j0 = max(int(rect.top // step_y), 0)
+        i1 = min(int(-(-rect.right // step_x)), self.samples[0] - 1)
+        j1 = min(int(-(-rect.bottom // step_y)), self.samples[1] - 1)
+        return i0, j0, i1, j1
+
+    def grid_bb(self, region):
+        i0, j0, i1, j1 = region
+        step_x, step_y = self.step
+        return BB(i0 * step_x, j0 * step_y, i1 * step_x, j1 * step_y)
+
+    def sample(self, region):
+        """
+        Samples the terrain mask at the grid points of the region in one
+        vectorized pass. Returns an array indexed [i, j]: 255 where solid,
+        0 where empty.
+        """
+        i0, j0, i1, j1 = region
+        step_x, step_y = self.step
+        xs = (np.arange(i0, i1 + 1) * step_x).astype(int)[:, None]
+        ys = (np.arange(j0, j1 + 1) * step_y).astype(int)[None, :]
+        return self.mask.at(xs, ys) * 255.0
+
+    def solid_cells(self, box):
+        """
+        Whether the terrain is solid at the centers of the distance field
+        cells in the box (x0, y0, x1, y1, in cells). Indexed [x, y].
+        """
+        x0, y0, x1, y1 = box
+        width, height = self.mask.size
+        xs = np.minimum(np.arange(x0, x1) * SDF_CELL + SDF_CELL // 2, width - 1)[:, None]
+        ys = np.minimum(np.arange(y0, y1) * SDF_CELL + SDF_CELL // 2, height - 1)[None, :]
+        return self.mask.at(xs, ys)
+
+    def has_terrain(self, pos, radius):
+        """
+        Whether there is anything left of the terrain in the circle.
+        """
+        return self.mask.any_in_circle(pos, radius)
+
+    def distance(self, pos):
+        """
+        Signed distance (px) from the point to the terrain surface, negative
+        inside terrain. Clamped to SDF_MAX_DIST.
+        """
+        return self.sdf.distance_at(pos)
+
+    def grid_data(self, region):
+        """
+        Samples of the grid region and the coordinates of its grid lines.
+        """
+        i0, j0, i1, j1 = region
+        step_x, step_y = self.step
+        xs = np.arange(i0, i1 + 1) * step_x
+        ys = np.arange(j0, j1 + 1) * step_y
+        return self.sample(region), xs, ys
+
+    def march(self, region):
+        """
+        Runs marching squares over the grid region and returns its geometry:
+        the simplified polylines, or convex polygons with the 'polys'
+        collider.
+        """
+        return self.trace(*self.grid_data(region))
+
+    def compile(self, cache_file=None):
+        """
+        Generates the geometry of every chunk. If a cache file is given, it is
+        loaded from it, or compiled and saved there if missing.
+        """
+        geometry = self.load_geometry(cache_file) if cache_file else None
+        if geometry is None:
+            geometry = [self.march(chunk.region) for chunk in self.chunks]
+            if cache_file:
+                self.save_geometry(cache_file, geometry)
+        return geometry
+
+    def build(self, geometry=None):
+        """
+        Creates the collision shapes of every chunk, from precompiled geometry
+        if given.
+        """
+        if geometry is None:
+            geometry = self.compile()
+        for chunk, chunk_geometry in zip(self.chunks, geometry):
+            self.set_chunk_geometry(chunk, chunk_geometry)
+            chunk.dirty = False
+
+    def load_geometry(self, cache_file):
         try:
-            p = int(point[0]), int(point[1])
-            color = surface.get_at(p)
-            #return color.hsla[2]  # use lightness
-            #return color[3]  # use alpha
-            magenta = color == pg.Color('magenta')
-            if magenta:
-                return 0
-            return color[3]  # use alpha or magenta
-        except Exception as e:
-            print(e)
-            return 0
-
-    line_set = pm.autogeometry.march_soft(
-        BB(0, 0, WORLD_WIDTH - 1, WORLD_HEIGHT - 1), 180, 180, 90, sample_func
-    )
-
-    for polyline in line_set:
-        line = pm.autogeometry.simplify_curves(polyline, 1.0)
-
-        for i in range(len(line) - 1):
-            p1 = line[i]
-            p2 = line[i + 1]
-            shape = pm.Segment(space.static_body, p1, p2, 1)
-            shape.collision_type = 2
-            shape.friction = 0.5
-            shape.color = pg.Color("red")
-            shape.generated = True
-            shape.is_ground = True
-            space.add(shape)
+            with open(cache_file) as f:
+                geometry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if len(geometry) != len(self.chunks):
+            print(f"Warning: ignoring terrain cache '{cache_file}' (chunks don't match).")
+            return None
+        return geometry
+
+    def save_geometry(self, cache_file, geometry):
+        # write to a temporary file first, other rooms may be reading the cache
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump([[[tuple(p) for p in line] for line in chunk_geometry] for chunk_geometry in geometry], f)
+        os.replace(tmp_file, cache_file)
+
+    def erase_circle(self, pos, radius):
+        """
+        Erases a circular piece of the terrain mask, updates the distance
+        field and marks the chunks it touches for rebuild.
+        """
+        if self.shared:
+            self.mask = self.mask.copy()
+            self.sdf = self.sdf.copy(self.solid_cells)
+            self.shared = False
+        area = self.mask.erase_circle(pos, radius)
+        if not area:
+            return
+        self.invalidate(area)
+        for i, (x0, y0, x1, y1) in enumerate(self.checksum_boxes):
+            if area.colliderect((x0, y0, x1 - x0, y1 - y0)):
+                self.checksums[i] = self.mask.checksum(self.checksum_boxes[i])
+        self.sdf.refresh((area.left // SDF_CELL, area.top // SDF_CELL, -(-area.right // SDF_CELL), -(-area.bottom // SDF_CELL)))
+
+    def invalidate(self, rect):
+        """
+        Marks the chunks affected by a change of the terrain mask inside the
+        given pg.Rect for rebuild.
+        """
+        i0, j0, i1, j1 = self.grid_region(rect)
+        for chunk in self.chunks:
+            ci0, cj0, ci1, cj1 = chunk.region
+            if ci0 <= i1 and i0 <= ci1 and cj0 <= j1 and j0 <= cj1:
+                chunk.dirty = True
+                chunk.version += 1
+
+    def rebuild(self):
+        if self.executor is None:
+            for chunk in self.chunks:
+                if chunk.dirty:
+                    self.rebuild_chunk(chunk)
+            return
+
+        # the samples are extracted here, the workers only get plain data
+        batch = []
+        for chunk in self.chunks:
+            if chunk.dirty and not chunk.rebuilding:
+                future = self.executor.submit(self.trace, *self.grid_data(chunk.region))
+                batch.append((chunk, chunk.version, future))
+                chunk.rebuilding = True
+                chunk.dirty = False
+        if batch:
+            self.batches.append(batch)
+
+    def swap_finished(self):
+        """
+        Swaps the geometry of finished background rebuilds into the space.
+        A batch is swapped only when all of its chunks are done, so that the
+        seams between them stay closed. Never waits for the workers.
+        """
+        stale = False
+        while self.batches and all(future.done() for _, _, future in self.batches[0]):
+            for chunk, version, future in self.batches.popleft():
+                chunk.rebuilding = False
+                if future.exception() is not None:
+                    print(f"Warning: terrain rebuild failed ({future.exception()}), rebuilding in the game thread.")
+                    self.rebuild_chunk(chunk)
+                elif version == chunk.version:
+                    self.set_chunk_geometry(chunk, future.result())
+                else:
+                    stale = True  # changed again meanwhile, still dirty
+
+        if stale:
+            self.rebuild()
+
+    def rebuild_chunk(self, chunk):
+        self.set_chunk_geometry(chunk, self.march(chunk.region))
+        chunk.dirty = False
+
+    def spatial_hash_params(self):
+        """
+        Cell size and cell count for space.use_spatial_hash: cells about the
+        size of an average terrain shape, and about ten cells per shape.
+        """
+        shapes = [shape for chunk in self.chunks for shape in chunk.shapes]
+        if not shapes:
+            return TERRAIN_CHUNK_SIZE, 1000
+        size = sum(max(shape.bb.right - shape.bb.left, shape.bb.top - shape.bb.bottom) for shape in shapes) / len(shapes)
+        return max(size, 1.0), max(10 * len(shapes), 1000)
+
+    def set_chunk_geometry(self, chunk, geometry):
+        if chunk.shapes:
+            self.space.remove(*chunk.shapes)
+        chunk.shapes = []
+        if self.collider == 'segments':
+            for line in geometry:
+                for i in range(len(line) - 1):
+                    chunk.shapes.append(self.make_shape(pm.Segment(chunk.body, line[i], line[i + 1], 1)))
+        else:
+            for polygon in geometry:
+                chunk.shapes.append(self.make_shape(pm.Poly(chunk.body, polygon, radius=1)))
+        if chunk.shapes:
+            self.space.add(*chunk.shapes)
+
+    @staticmethod
+    def make_shape(shape):
+        shape.collision_type = 2
+        shape.filter = pm.ShapeFilter(categories=TERRAIN_CATEGORY, mask=TERRAIN_MASK)
+        shape.friction = 0.5
+        return shape
+
+class MapAssets:
+    """
+    Decoded map shared by every room playing it: the terrain mask, the
+    compiled terrain geometry, the terrain distance field and the spawn data.
+    Rooms must not modify any of it (Terrain copies the mask and the
+    distance field on the first crater).
+    """
+    def __init__(self, map_index):
+        self.map = MAPS[map_index]
+        self.start_positions = self.map["start_positions"]
+        self.start_directions = self.map["start_directions"]
+        self.max_players = self.map["max_players"]
+        self.terrain_collider = self.map.get("terrain_collider", TERRAIN_COLLIDER)
+        self.broadphase = self.map.get("broadphase", BROADPHASE)
+
+        # the image is only needed for the mask
+        terrain_surface = pg.Surface(self.map["world_size"], flags=pg.SRCALPHA)
+        map_sprite = pg.image.load(self.map["terrain_file"])
+        map_rect = map_sprite.get_rect(bottomleft=(0, self.map["world_size"][1]))
+        terrain_surface.blit(map_sprite, map_rect)
+        self.terrain_mask = TerrainMask.from_surface(terrain_surface)
+
+        terrain = Terrain(self.terrain_mask, pm.Space(), shared=True, collider=self.terrain_collider)
+        self.geometry = terrain.compile(terrain_cache_file(self.map["terrain_file"], self.map["world_size"], self.terrain_collider))
+        self.sdf = terrain.sdf
+
+_map_assets = {}
+_map_assets_lock = threading.Lock()
+
+def get_map_assets(map_index):
+    """
+    Returns the shared assets of a map, loading them on first use.
+    """
+    with _map_assets_lock:
+        if map_index not in _map_assets:
+            _map_assets[map_index] = MapAssets(map_index)
+        return _map_assets[map_index]
+
+def begin_ground_contact(arb, space, data):
+    arb.shapes[0].body.ground_contacts += 1
+    return True
+
+def separate_ground_contact(arb, space, data):
+    # also called when the terrain shape is removed in a rebuild
+    arb.shapes[0].body.ground_contacts -= 1
+
+def begin_projectile_hit(arb, space, data):
+    # the first shape is the projectile, explode it once the step is done
+    if arb.shapes[1].collision_type == 1:
+        return True  # left the world, removed by pre_solve_static without exploding
+    projectile = arb.shapes[0].body
+    if not projectile.exploded:
+        space.add_post_step_callback(explode_projectile, projectile)
+    return False
+
+def explode_projectile(space, projectile):
+    if not projectile.exploded:
+        projectile.explode(space)
 
 def pre_solve_static(arb, space, data):
     s = arb.shapes[0]
     if type(s.body) is Tank:
         s.body.lose()
+    elif type(s.body) is Projectile:
+        s.body.exploded = True
+        s.body.game.delete_obj(s.body.id)
     space.remove(s.body, s)
     return False
 
@@ -180,6 +867,35 @@ class GameObject(pm.Body):
             #'angular_velocity':     ...,
         }
 
+    def save_state(self):
+        """
+        Everything needed to restore the object exactly in a lockstep
+        snapshot, unlike get_state which is what the clients draw.
+        """
+        return {
+            'id':                   self.id,
+            'position':             tuple(self.position),
+            'velocity':             tuple(self.velocity),
+            'angle':                self.angle,
+            'angular_velocity':     self.angular_velocity,
+            'direction':            tuple(self.direction),
+            'in_space':             self.space is not None,
+        }
+
+    def load_state(self, state):
+        self.position = state['position']
+        self.velocity = state['velocity']
+        self.angle = state['angle']
+        self.angular_velocity = state['angular_velocity']
+        self.direction = Vector(state['direction'])
+        self.prev_direction = self.direction
+
+    def set_owner(self, owner_id):
+        self.owner_id = owner_id
+        # the owner's tank and shells don't collide
+        group = owner_id + 1 if owner_id is not None else 0
+        self.shape.filter = self.shape.filter._replace(group=group)
+
     def serialize(self):
         pass
 
@@ -208,6 +924,9 @@ class Tank(GameObject):
         ]
         self.shape = pm.Poly(self, poly_points)
         self.shape.friction = 10.0
+        self.shape.collision_type = 3
+        self.shape.filter = pm.ShapeFilter(categories=TANK_CATEGORY, mask=TANK_MASK)
+        self.ground_contacts = 0    # terrain shapes touching the tank, counted by the collision handler
 
         # MULTIPLAYER - SERVER
         self.sprite_model = model
@@ -242,13 +961,7 @@ class Tank(GameObject):
         # if the roof is pointing to ground even slightly
         self.fallen_over = sin(self.angle + PI / 2) < 0
 
-        self.on_ground = False
-        if not self.fallen_over:
-            for s in space.shapes:
-                if hasattr(s, "is_ground") and s.is_ground:
-                    if self.shape.shapes_collide(s).points:
-                        self.on_ground = True
-                        break
+        self.on_ground = self.ground_contacts > 0 and not self.fallen_over
 
         if self.action_points <= 0:
             self.action_points = 0.0
@@ -262,9 +975,9 @@ class Tank(GameObject):
                 #self.apply_impulse_at_local_point(self.driving_direction * self.rotation_vector * 1000000 * delta, (0, 14))
                 self.shape.surface_velocity = -self.direction.x * self.rotation_vector * 5000 * delta
         
-        if self.driving_direction == 0:
+        if self.driving_direction == 0 and self.shape.surface_velocity != (0, 0):
             #self.shape.friction = 10.0
-            self.shape.surface_velocity = 0,0
+            self.shape.surface_velocity = 0,0   # wakes the body, so only when it changes
 
 
     def draw(self, scr, hud):
@@ -283,6 +996,7 @@ class Tank(GameObject):
 
         if self.has_lost:
             return
+        self.activate()
 
         if pg.K_LEFT in pressed:
             #self.velocity.x = -50
@@ -302,6 +1016,7 @@ class Tank(GameObject):
 
         if self.has_lost:
             return
+        self.activate()
 
         if pg.K_TAB in released:
             if not self.turn_ended:
@@ -343,10 +1058,10 @@ class Tank(GameObject):
             #projectile = Projectile(self.position + 50 * barrel_dir_vect)
             projectile = Projectile(self.position + 30 * barrel_dir_vect)
             projectile.velocity = 1000 * barrel_dir_vect
+            projectile.set_owner(self.owner_id)  # flies through the tank that shot it
             #self.apply_impulse_at_local_point(-20000 * barrel_dir_vect)
 
-            self.game.add_obj(projectile)
-            self.game.space.add(projectile, projectile.shape)
+            self.game.add_obj(projectile)  # the shell joins the space when it comes near something
 
     def start_turn(self):
         self.turn_ended = False
@@ -388,6 +1103,43 @@ class Tank(GameObject):
             #'barrel_angle_rate':    self.barrel_angle_rate
         } | super_state
 
+    def save_state(self):
+        # the ground contacts are counted again after loading, the contacts begin anew
+        return super().save_state() | {
+            'class':                'Tank',
+            'name':                 self.name,
+            'model':                self.sprite_model,
+            'owner_id':             self.owner_id,
+            'barrel_angle':         self.barrel_angle,
+            'barrel_angle_rate':    self.barrel_angle_rate,
+            'prev_barrel_angle':    self.prev_barrel_angle,
+            'driving_direction':    self.driving_direction,
+            'surface_velocity':     tuple(self.shape.surface_velocity),
+            'action_points':        self.action_points,
+            'turn_ended':           self.turn_ended,
+            'last_position':        tuple(self.last_position),
+            'fallen_over':          self.fallen_over,
+            'reset_angle':          self.reset_angle,
+            'health_points':        self.health_points,
+            'has_lost':             self.has_lost,
+        }
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.set_owner(state['owner_id'])
+        self.barrel_angle = state['barrel_angle']
+        self.barrel_angle_rate = state['barrel_angle_rate']
+        self.prev_barrel_angle = state['prev_barrel_angle']
+        self.driving_direction = state['driving_direction']
+        self.shape.surface_velocity = state['surface_velocity']
+        self.action_points = state['action_points']
+        self.turn_ended = state['turn_ended']
+        self.last_position = Vec2d(*state['last_position'])
+        self.fallen_over = state['fallen_over']
+        self.reset_angle = state['reset_angle']
+        self.health_points = state['health_points']
+        self.has_lost = state['has_lost']
+
 class Projectile(GameObject):
     def __init__(self, position, model=None):
         mass = 25
@@ -395,8 +1147,17 @@ class Projectile(GameObject):
         super().__init__(mass, moment=moment)
         self.position = Vec2d(*position)
         self.shape = pm.Circle(self, 5)
+        self.shape.collision_type = 4  # impacts are handled by begin_projectile_hit
+        self.shape.filter = pm.ShapeFilter(categories=PROJECTILE_CATEGORY, mask=PROJECTILE_MASK)
         self.owner_id = None
         self.exploded = False
+        self.last_position = self.position  # before the physics step, for the swept collision
+        # ballistic flight outside the space: start position and velocity, gravity
+        # and step of the parabola, steps along it and steps left before the
+        # surroundings are checked again
+        self.flight = None
+        self.flight_steps = 0
+        self.clear_steps = 0
 
     def initialize(self):
         super().initialize()
@@ -404,20 +1165,95 @@ class Projectile(GameObject):
 
     def update(self, delta, space):
         super().update(delta)
-
         if self.exploded:
             return
+        if self.clear_steps == 0:
+            self.follow_flight()
+            self.clear_steps = self.steps_in_open_air(delta, space)
+            if self.clear_steps == 0:
+                # something is within reach, the physics takes over from here
+                if self.space is None:
+                    space.add(self, self.shape)
+                self.flight = None
+            elif self.flight is None:
+                # just shot or left the physics: a new parabola from here
+                if self.space is not None:
+                    space.remove(self, self.shape)
+                self.flight = self.position, self.velocity, Vec2d(*space.gravity), delta
+                self.flight_steps = 0
+        if self.flight is None:
+            self.last_position = self.position
+        else:
+            self.clear_steps -= 1
+            self.flight_steps += 1
 
-        # TODO: Check collisions --> explode
-        self.collides = False
-        for s in space.shapes:
-            if self.shape.shapes_collide(s).points:
-                if s is self.shape:
-                    continue
-                self.collides = True
-                break
+    def follow_flight(self):
+        """
+        Moves the shell to where it is on its ballistic flight, which is only
+        done when needed. Same positions as the space's integrator (position
+        first, then velocity), but computed from the start of the flight so
+        the error doesn't add up.
+        """
+        if self.flight is None:
+            return
+        (x, y), (vx, vy), (gx, gy), delta = self.flight
+        n = self.flight_steps
+        t, c = n * delta, n * (n - 1) / 2 * delta * delta
+        self.position = x + t * vx + c * gx, y + t * vy + c * gy
+        self.velocity = vx + t * gx, vy + t * gy
 
-        if self.collides:
+    def steps_in_open_air(self, delta, space):
+        """
+        How many steps the shell can fly for sure without hitting anything:
+        terrain (by the distance field), walls and the tanks and shells in
+        the space it can hit, which may be coming closer at their own speed.
+        Shells flying outside the space don't see each other.
+        """
+        gravity = Vec2d(*space.gravity).length
+        speed = self.velocity.length
+        x, y = self.position
+        # the walls are 45 px outside the world
+        gaps = [(min(self.game.terrain.distance(self.position) - SDF_CELL, x + 45, WORLD_WIDTH + 45 - x, y + 45, WORLD_HEIGHT + 45 - y), 0)]
+        # terrain is in the distance field, the owner's tank and shells are in the shell's group
+        query_filter = pm.ShapeFilter(group=self.shape.filter.group, mask=TANK_CATEGORY | PROJECTILE_CATEGORY)
+        for hit in space.point_query(self.position, inf, query_filter):
+            if hit.shape.body is not self:
+                gaps.append((hit.distance, hit.shape.body.velocity.length))
+
+        steps = BALLISTIC_STEPS
+        for gap, closing_speed in gaps:
+            gap -= self.shape.radius
+            if gap <= 0:
+                return 0
+            # time until both have moved the gap at most: gravity * t^2 + (speed + closing_speed) * t = gap
+            b = speed + closing_speed
+            t = 2 * gap / (b + sqrt(b * b + 4 * gravity * gap))
+            steps = min(steps, int(t / delta))
+        return steps
+
+    def sweep(self, space):
+        """
+        Swept collision after the physics step: a fast shell can pass through
+        thin terrain between two steps, so the path it moved along is checked
+        and the shell explodes at the first thing on it. Shapes it already
+        touched at the start of the step are left to the collision handler.
+        """
+        if self.exploded or self.space is None:  # nothing was in reach of a ballistic shell
+            return
+        hits = [
+            hit for hit in space.segment_query(self.last_position, self.position, self.shape.radius, self.shape.filter)
+            if hit.shape.body is not self and hit.alpha > 0
+        ]
+        if not hits:
+            return
+        hit = min(hits, key=lambda hit: hit.alpha)
+        if hit.shape.collision_type == 1:
+            # left the world, like in pre_solve_static
+            self.exploded = True
+            self.game.delete_obj(self.id)
+            space.remove(self, self.shape)
+        else:
+            self.position = self.last_position.interpolate_to(self.position, hit.alpha)
             self.explode(space)
 
     def draw(self, scr, hud):
@@ -428,23 +1264,26 @@ class Projectile(GameObject):
     def explode(self, space):
         def calc_explosion_effect(dist, max_dist, max_effect):
             return max_effect / max_dist * (max_dist + 1 - dist)
-        # TODO: Not always need to update the map (explosion over ground etc)!
         self.game.erase_map_circle(self.position, 30)
-        for s in space.shapes:
-            if type(s.body) is Tank:
-                # this is very naive (assumes point-like shapes)
-                dist = self.position.get_distance(s.body.position)
-                # dist = 75 -> explosion_effect = 1
-                # dist = 0  -> explosion_effect = 100
-                if dist <= 120:
-                    explosion_effect = calc_explosion_effect(dist, 120, 100)
-                    impulse_direction = (s.body.position - self.position).normalized()
-                    s.body.apply_impulse_at_local_point(20000 * explosion_effect * impulse_direction)
-                    s.body.take_damage(explosion_effect / 3)  # direct hit is about 30 % of HP
+
+        # tanks within the blast, by the distance to the nearest point of the hull
+        hits = space.point_query(self.position, 120, pm.ShapeFilter(mask=TANK_CATEGORY))
+        effects = []
+        for hit in hits:
+            # dist = 120 -> explosion_effect = 0.83 (0.28 HP of damage)
+            # dist = 0   -> explosion_effect = 100.8, also from inside the hull (the distance is clamped to 0)
+            explosion_effect = calc_explosion_effect(max(hit.distance, 0), 120, 100)
+            impulse_direction = (hit.shape.body.position - self.position).normalized()
+            effects.append((hit.shape.body, explosion_effect, impulse_direction))
+
+        for tank, explosion_effect, impulse_direction in effects:
+            tank.activate()  # impulses don't wake sleeping bodies
+            tank.apply_impulse_at_local_point(20000 * explosion_effect * impulse_direction)
+            tank.take_damage(explosion_effect / 3)  # direct hit is about 30 % of HP
 
         self.game.delete_obj(self.id)
         try:  # remove if exists
-            self.game.space.remove(self.shape)
+            self.game.space.remove(self, self.shape)
         except:
             pass
         self.exploded = True
@@ -455,6 +1294,7 @@ class Projectile(GameObject):
     #----------------------------------
 
     def get_state(self):
+        self.follow_flight()
         super_state = super().get_state()
         return {
             # mostly static
@@ -462,8 +1302,37 @@ class Projectile(GameObject):
             'id':                   self.id,
             'owner_id':             self.owner_id,
             #'model':                'CIRCLE-5'
-            'exploded':             self.exploded
+            'exploded':             self.exploded,
+            'velocity':             tuple(self.velocity),  # clients extrapolate the flight
         } | super_state
+
+    def save_state(self):
+        self.follow_flight()
+        flight = None
+        if self.flight is not None:
+            position, velocity, gravity, delta = self.flight
+            flight = [tuple(position), tuple(velocity), tuple(gravity), delta]
+        return super().save_state() | {
+            'class':                'Projectile',
+            'owner_id':             self.owner_id,
+            'exploded':             self.exploded,
+            'last_position':        tuple(self.last_position),
+            'flight':               flight,
+            'flight_steps':         self.flight_steps,
+            'clear_steps':          self.clear_steps,
+        }
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.set_owner(state['owner_id'])
+        self.exploded = state['exploded']
+        self.last_position = Vec2d(*state['last_position'])
+        self.flight = None
+        if state['flight'] is not None:
+            position, velocity, gravity, delta = state['flight']
+            self.flight = Vec2d(*position), Vec2d(*velocity), Vec2d(*gravity), delta
+        self.flight_steps = state['flight_steps']
+        self.clear_steps = state['clear_steps']
         
 
 # ------------------------------------------------------------------------------
@@ -505,6 +1374,10 @@ class ObjectContainer:
         self.last_id += 1
         return obj_id
 
+    def replace(self, obj_id, obj):
+        # add object to queue with the given ID
+        self._pending_addition.add((obj_id, obj))
+
     def delete(self, id):
         if type(id) is int or id.isdigit():  # numeric string is allowed
             self._pending_delete.add(id)
@@ -523,7 +1396,8 @@ class ObjectContainer:
         self._add_pending()
 
     def _add_pending(self):
-        for obj_id, obj in self._pending_addition:
+        # in ID order, so that every lockstep peer goes through the objects in the same order
+        for obj_id, obj in sorted(self._pending_addition, key=lambda pending: pending[0]):
             self._objs[obj_id] = obj
         self._pending_addition.clear()
 
@@ -535,6 +1409,48 @@ class ObjectContainer:
                 print("Warning: trying to delete non-existing object.")
         self._pending_delete.clear()
 
+class CraterJournal:
+    """
+    The latest craters erased from the terrain, so that they can be replayed
+    to clients. Erasing is a union of circles, so the journal is compacted
+    without changing the result: duplicates and craters inside an earlier
+    one are not added, and earlier craters inside a new one are dropped.
+    Each added crater gets the next version, which clients acknowledge once
+    they have applied it.
+
+    At most max_entries craters are kept. The older ones are folded into the
+    base version: the terrain mask itself holds them, and a client that is
+    behind the base needs a terrain snapshot instead.
+    """
+    def __init__(self, max_entries=CRATER_JOURNAL_SIZE):
+        self.version = 0
+        self.base = 0       # craters up to this version are only in the terrain
+        self.max_entries = max_entries
+        self.entries = []   # (version, pos, radius), oldest first
+
+    @staticmethod
+    def contains(outer_pos, outer_radius, pos, radius):
+        dist = Vec2d(*outer_pos).get_distance(pos)
+        return dist + radius <= outer_radius + 1e-9
+
+    def add(self, pos, radius):
+        pos = (float(pos[0]), float(pos[1]))
+        for _, p, r in self.entries:
+            if self.contains(p, r, pos, radius):
+                return False
+        self.entries = [e for e in self.entries if not self.contains(pos, radius, e[1], e[2])]
+        self.version += 1
+        self.entries.append((self.version, pos, radius))
+        if len(self.entries) > self.max_entries:
+            self.base = self.entries.pop(0)[0]
+        return True
+
+    def since(self, version):
+        """
+        Map updates for a client that has applied everything up to the version.
+        """
+        return [('CIRCLE', (pos, radius), v) for v, pos, radius in self.entries if v > version]
+
 class Client:
     def __init__(self, socket, player_name):
         self.socket = socket
@@ -543,13 +1459,20 @@ class Client:
         self.id = None
         self.obj_id = None  # object controlled by the client
         self.disconnected = False
+        self.map_version = None # crater journal version the client has acknowledged, None until it has a snapshot
+        self.snapshot = None    # terrain snapshot messages still to be sent
 
 class Game:
-    def __init__(self, room_key, send_message_cb):
+    terrain_in_background = True    # terrain geometry is rebuilt by the terrain workers (if any)
+    threaded_solver = True          # the map's solver setting is used (threads make the physics nondeterministic)
+
+    def __init__(self, room_key, send_message_cb, map_index=DEFAULT_MAP, rx_queue=None, lockstep=False):
 
         # Server stuff...
         self.room_key = room_key
-        self.rx_queue = janus.Queue()
+        self.map_index = map_index
+        self.map = MAPS[map_index]
+        self.rx_queue = rx_queue if rx_queue is not None else janus.Queue()
         self.send_message = lambda m, c: send_message_cb(self.room_key, m, c)
         self.future = None
         self.full = False
@@ -560,12 +1483,27 @@ class Game:
 
         self.running = False
         self.current_tick = 0
-        self.delta = 0.0
+        self.delta = 1.0 / TICK_RATE    # fixed step, everything is simulated with it
+        self.accumulator = 0.0          # time not simulated yet
 
         self.clients = ObjectContainer()
         self.objects = ObjectContainer()
 
-        self.TEST_map_updates = []
+        self.craters = CraterJournal()
+        self.pending_craters = []   # erased at the end of the tick
+        self.updates_sent = 0
+        self.woken_by = []          # messages received while idle
+
+        # lockstep: the clients run the same simulation with the inputs sent to them
+        self.lockstep = lockstep
+        if lockstep:
+            self.terrain_in_background = False  # the terrain must change at the same tick everywhere
+            self.threaded_solver = False
+        self.inputs = []            # [tick, client_id, events] not sent yet
+        self.inputs_sent_tick = 0   # the clients may simulate up to this tick
+        self.state_hash_at = None   # (tick, hash) of the latest state hash
+        self.resync = False         # everyone restarts from a snapshot (a client joined, left or desynced)
+        self.snapshot_lock = threading.Lock()  # joins and leaves (server thread) wait for a snapshot reload to finish
 
     def init_game(self):
         #--------------------------------------
@@ -577,10 +1515,34 @@ class Game:
         #--------------------------------------
         # Init Pymunk
         #--------------------------------------
-        self.space = pm.Space()
-        self.space.gravity = 0, 980
+        self.init_space()
+
+    def init_space(self):
+        self.solver = self.map.get("solver", SOLVER) if self.threaded_solver else 'single'
+        if self.solver == 'auto' and (os.cpu_count() or 1) < 2:
+            self.solver = 'single'
+        elif self.solver not in ('single', 'threaded', 'auto'):
+            raise ValueError(f"Unknown solver '{self.solver}'")
+
+        # threads can be turned on and off later only in a space created threaded
+        self.space = pm.Space(threaded=self.solver != 'single')
+        if self.solver == 'threaded':
+            self.space.threads = SOLVER_THREADS
+        self.space.gravity = GRAVITY
+        self.space.sleep_time_threshold = SLEEP_TIME_THRESHOLD
+
+    def set_solver_threads(self):
+        """
+        The threaded solver is slower than the single-threaded one until
+        there are a lot of bodies, 'auto' rooms switch the threads on and
+        off as the objects come and go.
+        """
+        if self.solver == 'auto':
+            threads = SOLVER_THREADS if self.objects.count() >= THREADED_SOLVER_OBJECTS else 1
+            if self.space.threads != threads:
+                self.space.threads = threads
 
-    def init_world(self):
+    def init_world(self, terrain_mask=None):
         # static walls of the world
         static = [
             pm.Segment(self.space.static_body, (-50, -50), (-50, WORLD_HEIGHT + 50), 5),
@@ -590,16 +1552,41 @@ class Game:
         ]
         for s in static:
             s.collision_type = 1
+            s.filter = pm.ShapeFilter(categories=WALL_CATEGORY, mask=WALL_MASK)
         self.space.add(*static)
 
+        # collision types: 0 = objects, 1 = walls, 2 = terrain, 3 = tanks, 4 = projectiles
         self.space.add_collision_handler(0, 1).pre_solve = pre_solve_static
+        self.space.add_collision_handler(3, 1).pre_solve = pre_solve_static
+        self.space.add_collision_handler(4, 1).pre_solve = pre_solve_static
+        self.space.add_wildcard_collision_handler(4).begin = begin_projectile_hit
+        ground_handler = self.space.add_collision_handler(3, 2)
+        ground_handler.begin = begin_ground_contact
+        ground_handler.separate = separate_ground_contact
+
+        # the map is shared between rooms, the terrain copies it when modified
+        self.assets = get_map_assets(self.map_index)
+        executor = get_terrain_executor() if self.terrain_in_background else None
+        if terrain_mask is None:
+            self.terrain = Terrain(self.assets.terrain_mask, self.space, shared=True,
+                                   executor=executor, sdf=self.assets.sdf,
+                                   collider=self.assets.terrain_collider)
+            self.terrain.build(self.assets.geometry)
+        else:
+            self.terrain = Terrain(terrain_mask, self.space, executor=executor,
+                                   collider=self.assets.terrain_collider)
+            self.terrain.build()
+        self.set_broadphase(self.assets.broadphase)
 
-        self.terrain_surface = pg.Surface((WORLD_WIDTH, WORLD_HEIGHT), flags=pg.SRCALPHA)
-
-        map_sprite = pg.image.load(MAP["terrain_file"])
-        map_rect = map_sprite.get_rect(bottomleft=(0, WORLD_HEIGHT))
-        self.terrain_surface.blit(map_sprite, map_rect)
-        generate_geometry(self.terrain_surface, self.space)
+    def set_broadphase(self, broadphase):
+        """
+        The space starts with a bounding box tree. A spatial hash suits the
+        many small, similar terrain shapes better on some maps.
+        """
+        if broadphase == 'spatial_hash':
+            self.space.use_spatial_hash(*self.terrain.spatial_hash_params())
+        elif broadphase != 'bbtree':
+            raise ValueError(f"Unknown broadphase '{broadphase}'")
 
     def initialize(self):
         self.init_world()
@@ -609,7 +1596,7 @@ class Game:
             obj.initialize()
 
     def get_messages(self):
-        messages = []
+        messages, self.woken_by = self.woken_by, []
         while not self.rx_queue.sync_q.empty():
             messages.append(self.rx_queue.sync_q.get())
         return messages
@@ -619,10 +1606,34 @@ class Game:
         self.objects.apply_pending_changes()
 
         self.check_events()
+        if self.resync:
+            self.send_snapshot()
+        if self.is_idle():
+            self.send_update()
+            self.idle_wait()
+            return
+
+        # as many fixed steps as the time passed requires
+        self.accumulator = min(self.accumulator, MAX_CATCHUP_STEPS * self.delta)
+        while self.accumulator >= self.delta:
+            self.accumulator -= self.delta
+            self.step()
+        if self.lockstep:
+            self.send_update()  # the inputs and how far to simulate, after the steps
+        self.accumulator += self.clock.tick(TICK_RATE) / 1000
+
+    def step(self):
+        """
+        One fixed step of the game.
+        """
+        self.check_turn()
         self.update()
-        if self.current_tick % FRAMES_PER_UPDATE == 0:  # time to send an update
+        if self.current_tick % FRAMES_PER_UPDATE == 0 and not self.lockstep:  # time to send an update
             self.send_update()
         self.tick()
+        self.objects.apply_pending_changes()
+        if self.lockstep and self.current_tick % LOCKSTEP_HASH_TICKS == 0:
+            self.state_hash_at = (self.current_tick, self.state_hash())
 
     def check_events(self):
         messages = self.get_messages()
@@ -633,11 +1644,15 @@ class Game:
                     client_id = message['client_id']
                     event_type = event['type']
 
-                    # check if there are old messages in queue from players that have left...
-                    if self.clients.exists(client_id):
-                        client = self.clients.get(client_id)
-                    if self.objects.exists(client.obj_id):
-                        player = self.objects.get(client.obj_id)
+                    # skip old messages in queue from players that have left...
+                    if not self.clients.exists(client_id):
+                        continue
+                    client = self.clients.get(client_id)
+                    if not self.objects.exists(client.obj_id):
+                        continue
+                    player = self.objects.get(client.obj_id)
+                    if self.lockstep:
+                        self.inputs.append([self.current_tick, client_id, [event]])
 
                     # type: KEYDOWN, value: key
                     if event_type == 'KEYDOWN':
@@ -649,10 +1664,43 @@ class Game:
                         key = event['value']
                         player.key_up([key])
 
+            # client's terrain differs in the chunks, resend them
+            elif message['type'] == 'map_repair':
+                if self.clients.exists(message['client_id']):
+                    client = self.clients.get(message['client_id'])
+                    if client.snapshot is None and client.map_version is not None:
+                        boxes = [self.terrain.checksum_boxes[i] for i in message['chunks'] if 0 <= i < len(self.terrain.checksum_boxes)]
+                        client.snapshot = self.terrain_snapshot(boxes)
+
+            # client has applied the map updates up to the version
+            elif message['type'] == 'map_ack':
+                if self.clients.exists(message['client_id']):
+                    client = self.clients.get(message['client_id'])
+                    if client.map_version is not None:
+                        client.map_version = max(client.map_version, int(message['version']))
+
+            # lockstep client's state hash differs from ours
+            elif message['type'] == 'resync':
+                self.resync = self.lockstep
+
+    def check_turn(self):
+        # every step, so that the turns change at the same tick on every lockstep peer
         if self.clients.count() > 0:
             if self.current_player is None or (self.objects.exists(self.current_player.obj_id) and self.objects.get(self.current_player.obj_id).turn_ended):
                 self.next_turn()
 
+    def turn_passing(self):
+        """
+        The current player's turn has ended and there is someone to take
+        it. check_turn gives it on in the next step, the room can't idle
+        before that.
+        """
+        if self.current_player is None or not self.objects.exists(self.current_player.obj_id):
+            return False
+        if not self.objects.get(self.current_player.obj_id).turn_ended:
+            return False
+        return any(self.objects.exists(c.obj_id) and not self.objects.get(c.obj_id).has_lost for c in self.clients.as_list())
+
     def next_turn(self, client_id=None):
         if client_id is None:
             # find next client in the list (wraps back to the previous current if alone)
@@ -683,25 +1731,68 @@ class Game:
         self.current_player = client
         self.objects.get(self.current_player.obj_id).start_turn()
 
+    def is_idle(self):
+        """
+        Nothing in the room can move until someone acts: every tank is at
+        rest and asleep, no one is steering, and there are no projectiles,
+        terrain changes or turn changes in progress.
+        """
+        if self.pending_craters or self.terrain.batches or self.turn_passing():
+            return False
+        for obj in self.objects.as_list():
+            if type(obj) is not Tank:
+                return False
+            if obj.space is not None and not obj.is_sleeping:
+                return False
+            if obj.driving_direction != 0 or obj.barrel_angle_rate != 0 or obj.reset_angle:
+                return False
+        return True
+
+    def idle_wait(self):
+        """
+        Waits for the next message, at most one idle loop. The physics stays
+        stopped, so a message wakes the room right away.
+        """
+        try:
+            self.woken_by.append(self.rx_queue.sync_q.get(timeout=1 / IDLE_TICK_RATE))
+        except queue.Empty:
+            pass
+        self.clock.tick()  # the idle time is not simulated
+        self.accumulator = 0.0
+
     def update(self):
+        # terrain rebuilt in the background is swapped in between steps
+        self.terrain.swap_finished()
+
         for obj_id, obj in self.objects.all():
             obj.update(self.delta, self.space)
 
-        self.space.step(1.0 / TICK_RATE)
+        self.set_solver_threads()
+        self.space.step(self.delta)
+
+        for obj_id, obj in self.objects.all():
+            if type(obj) is Projectile:
+                obj.sweep(self.space)
 
         if self.objects.exists(self.current_player.obj_id):
             self.objects.get(self.current_player.obj_id).update_action_points(self.delta)
 
+        self.apply_craters()
+
     def send_update(self, client=None):
         #self.tx_queue.sync_q.put({'type': 'test', 'tick': self.tick})
         #message = {'type': 'tick', 'tick': self.current_tick}
         #self.send_message(message, client)
 
+        if self.lockstep:
+            self.send_lockstep_update()
+            return
+
         # TODO: send incremental update here!
         self.send_absolute_update()
+        self.updates_sent += 1
 
     def tick(self):
-        self.delta = self.clock.tick(TICK_RATE) / 1000
         self.current_tick += 1
 
         for obj_id, obj in self.objects.all():
@@ -720,11 +1811,21 @@ class Game:
 
     def erase_map_circle(self, pos, radius):
         """
-        Erases a circular piece of the map and updates the collision map.
+        Erases a circular piece of the map. The collision map is updated at
+        the end of the tick, once for all craters of the tick.
         """
-        pg.draw.circle(self.terrain_surface, pg.Color('magenta'), pos, radius)
-        generate_geometry(self.terrain_surface, self.space)
-        self.TEST_map_updates.append(('CIRCLE', (pos, radius)))
+        if not self.terrain.has_terrain(pos, radius):
+            return  # nothing to erase
+        self.pending_craters.append((pos, radius))
+        self.craters.add(pos, radius)
+
+    def apply_craters(self):
+        if not self.pending_craters:
+            return
+        for pos, radius in self.pending_craters:
+            self.terrain.erase_circle(pos, radius)
+        self.pending_craters = []
+        self.terrain.rebuild()
 
 
     #----------------------------------
@@ -736,36 +1837,40 @@ class Game:
         # TODO: Respond negatively if cannot join (full lobby or so)
         def next_tank_model(client_id):
             return TANK_MODELS[client_id % len(TANK_MODELS)]
-        # add a client and tank (object) for the new player
-        client = Client(socket, name)
-        client_id = self.clients.add(client)
-        client.id = client_id
-        # create tank for the client
-        obj = Tank(name, MAP["start_positions"][client_id], next_tank_model(client_id))
-        obj.direction = MAP["start_directions"][client_id]
-        obj.owner_id = client_id    # the object belongs to the client
-        self.add_obj(obj)
-        self.space.add(obj, obj.shape)
-        client.obj_id = obj.id
-
-        if self.clients.count(include_pending=True) >= MAP["max_players"]:
-            self.full = True
-        if self.clients.count(include_pending=True) == 1:
-            self.current_player = client
+        with self.snapshot_lock:
+            # add a client and tank (object) for the new player
+            client = Client(socket, name)
+            client_id = self.clients.add(client)
+            client.id = client_id
+            # create tank for the client
+            obj = Tank(name, self.map["start_positions"][client_id], next_tank_model(client_id))
+            obj.direction = self.map["start_directions"][client_id]
+            obj.set_owner(client_id)    # the object belongs to the client
+            self.add_obj(obj)
+            self.space.add(obj, obj.shape)
+            client.obj_id = obj.id
+
+            if self.clients.count(include_pending=True) >= self.map["max_players"]:
+                self.full = True
+            if self.clients.count(include_pending=True) == 1:
+                self.current_player = client
+            self.resync = self.lockstep  # the new client starts from a snapshot
 
         return client
 
     def leave(self, client_id):
-        try:
-            if self.current_player.id == client_id:
-                self.next_turn()  # give turn to next player if current leaves
-            client = self.clients.get(client_id)
-        except:
-            return
-        client.disconnected = True
-        obj_id = client.obj_id
-        self.objects.delete(obj_id)
-        self.clients.delete(client_id)
+        with self.snapshot_lock:
+            try:
+                if self.current_player.id == client_id:
+                    self.next_turn()  # give turn to next player if current leaves
+                client = self.clients.get(client_id)
+            except:
+                return
+            client.disconnected = True
+            obj_id = client.obj_id
+            self.objects.delete(obj_id)
+            self.clients.delete(client_id)
+            self.resync = self.lockstep
 
     def stop(self):
         print("Stopping game.")
@@ -776,16 +1881,163 @@ class Game:
 
     def send_absolute_update(self, client=None):
         #self.tx_queue.sync_q.put({'type': 'test', 'tick': self.tick})
-        message = {'type': 'game_state', 'state': self.get_game_state()}
-        self.send_message(message, client)
+        state = self.get_game_state()
+        receivers = [c for c in list(self.clients.as_list()) if client is None or c.id == client]
+        if all(c.snapshot is None and c.map_version is not None and c.map_version >= self.craters.version for c in receivers):
+            self.send_message({'type': 'game_state', 'state': state}, client)
+            return
+
+        for c in receivers:
+            # joined clients and the ones too far behind get the terrain as a snapshot first
+            if c.snapshot is None and (c.map_version is None or c.map_version < self.craters.base):
+                c.snapshot = self.terrain_snapshot()
+            if c.snapshot:
+                message = c.snapshot.popleft()
+                self.send_message(message, c.id)
+                if c.snapshot:
+                    self.send_message({'type': 'game_state', 'state': state}, c.id)
+                    continue
+                c.snapshot = None
+                if message['version'] is not None:
+                    c.map_version = message['version']
+
+            # the craters a client hasn't acknowledged are (re)sent to it
+            map_update = self.craters.since(c.map_version)
+            client_state = state | {'map_update': map_update} if map_update else state
+            self.send_message({'type': 'game_state', 'state': client_state}, c.id)
+
+    def terrain_snapshot(self, boxes=None):
+        """
+        Messages with the terrain chunks that differ from the original map,
+        run-length encoded and split in pieces to be sent one per update. The
+        last piece has the crater journal version the snapshot is up to.
+
+        If chunk boxes are given, only those are sent to repair a client's
+        terrain, and the version is left out: the client may still be missing
+        craters elsewhere.
+        """
+        mask = self.terrain.mask
+        version = self.craters.version
+        if boxes is None:
+            boxes = mask.changed_boxes(self.assets.terrain_mask, SNAPSHOT_CHUNK_SIZE)
+        else:
+            version = None
+        chunks = [list(box) + [mask.encode_rows(box)] for box in boxes]
+        pieces = [chunks[i:i + SNAPSHOT_CHUNKS_PER_MESSAGE] for i in range(0, len(chunks), SNAPSHOT_CHUNKS_PER_MESSAGE)] or [[]]
+        return collections.deque({
+            'type': 'map_snapshot',
+            'version': version if i == len(pieces) - 1 else None,
+            'chunks': piece
+        } for i, piece in enumerate(pieces))
+
+    def send_lockstep_update(self):
+        """
+        The inputs the clients haven't got yet, each with the tick it was
+        handled at, and the tick they may simulate up to. Sent when there are
+        new inputs or FRAMES_PER_UPDATE ticks have passed, so an idle room
+        sends nothing. The latest state hash goes along for the clients to
+        check against.
+        """
+        if not self.inputs and self.current_tick - self.inputs_sent_tick < FRAMES_PER_UPDATE:
+            return
+        message = {'type': 'lockstep', 'tick': self.current_tick, 'inputs': self.inputs}
+        if self.state_hash_at is not None and self.state_hash_at[0] > self.inputs_sent_tick:
+            message['hash'] = list(self.state_hash_at)
+        self.send_message(message, None)
+        self.inputs = []
+        self.inputs_sent_tick = self.current_tick
+
+    def send_snapshot(self):
+        """
+        Restarts the lockstep game from a snapshot of it, here and on every
+        client: restoring doesn't carry over the contacts and sleeping of
+        the bodies, so only peers that all restored step the same way. The
+        inputs handled so far are in the snapshot. Joins and leaves wait
+        until the room is reloaded, they resync it again.
+        """
+        with self.snapshot_lock:
+            self.resync = False
+            self.clients.apply_pending_changes()
+            self.objects.apply_pending_changes()
+            snapshot = self.get_snapshot()
+            self.load_snapshot(snapshot)
+        self.send_message({'type': 'lockstep_snapshot', 'snapshot': snapshot}, None)
+        self.inputs = []
+        self.inputs_sent_tick = self.current_tick
+        self.state_hash_at = None
+
+    def get_snapshot(self):
+        """
+        The whole simulation for a lockstep client to start from.
+        """
+        mask = self.terrain.mask
+        return {
+            'tick':             self.current_tick,
+            'current_player':   self.current_player.id if self.current_player is not None else None,
+            'clients':          [[c.id, c.player_name, c.obj_id] for c in self.clients.as_list()],
+            'last_client_id':   self.clients.last_id,
+            'objects':          sorted((obj.save_state() for obj in self.objects.as_list()), key=lambda state: state['id']),
+            'last_object_id':   self.objects.last_id,
+            'terrain':          [*mask.size, base64.b64encode(zlib.compress(mask.bits.tobytes())).decode()],
+        }
+
+    def load_snapshot(self, snapshot):
+        """
+        Restarts the game from a snapshot: the space, terrain and objects are
+        built anew. Clients already in the room are kept.
+        """
+        width, height, data = snapshot['terrain']
+        bits = np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype=np.uint8).reshape(width, -1).copy()
+        self.init_space()
+        self.init_world(TerrainMask(bits, (width, height)))
+        self.pending_craters = []
+
+        clients = ObjectContainer()
+        for client_id, player_name, obj_id in snapshot['clients']:
+            client = self.clients.get(client_id) if self.clients.exists(client_id) else Client(None, player_name)
+            client.id = client_id
+            client.obj_id = obj_id
+            clients.replace(client_id, client)
+        clients.last_id = snapshot['last_client_id']
+        clients.apply_pending_changes()
+        self.clients = clients
+
+        self.objects = ObjectContainer()
+        for state in snapshot['objects']:
+            if state['class'] == 'Tank':
+                obj = Tank(state['name'], state['position'], state['model'])
+            else:
+                obj = Projectile(state['position'])
+            obj.load_state(state)
+            obj.id = state['id']
+            obj.game = self
+            self.objects.replace(obj.id, obj)
+            if state['in_space']:
+                self.space.add(obj, obj.shape)
+            obj.initialize()
+        self.objects.last_id = snapshot['last_object_id']
+        self.objects.apply_pending_changes()
+
+        self.current_tick = snapshot['tick']
+        self.current_player = self.clients.get(snapshot['current_player']) if snapshot['current_player'] is not None else None
+        self.running = True
+
+    def state_hash(self):
+        """
+        Hash of the simulation state, which lockstep peers compare to notice
+        they have gone out of sync.
+        """
+        objects = [obj.save_state() for obj in self.objects.as_list()]
+        state = [self.current_tick, self.current_player.id if self.current_player is not None else None, objects, self.terrain.checksums]
+        return zlib.crc32(encode_msg(state).encode())
 
     def get_game_state(self):
         game_state = {}
         game_state['current_player'] = self.current_player.id
-
-        if self.TEST_map_updates:
-            game_state['map_update'] = self.TEST_map_updates
-            self.TEST_map_updates = []
+        game_state['map_version'] = self.craters.version
+        if self.updates_sent % CHECKSUM_UPDATES == 0:
+            # the client compares these to its terrain when it's up to the version
+            game_state['map_checksums'] = self.terrain.checksums
 
         objects = {}
 
@@ -808,6 +2060,84 @@ class Game:
     def client_count(self):
         return len([c.id for c in self.clients.as_list() if not c.disconnected])
 
+class LocalQueue:
+    """
+    Stands in for a room's janus queue when there is no event loop. Only the
+    game thread's end of it (sync_q) is used.
+    """
+    def __init__(self):
+        self.sync_q = queue.Queue()
+
+    def close(self):
+        pass
+
+class Simulation(Game):
+    """
+    A room without a server, clients or clock for balance tests, regression
+    tests and profiling. Players are scripted with key events and the game
+    is stepped as fast as it runs, also when a real room would idle. Terrain
+    is rebuilt in the game thread and the physics runs on one thread, so
+    the same script plays the same game.
+
+        sim = Simulation(map_index=1)
+        a, b = sim.add_player('a'), sim.add_player('b')
+        sim.initialize()
+        sim.key_up(a, pg.K_SPACE)
+        sim.run_until(sim.is_idle, max_steps=10 * TICK_RATE)
+
+    Updates to the clients are only made if someone listens to them
+    (send_message_cb(room_key, message, client_id)). The lockstep clients
+    simulate their game with one too.
+    """
+    terrain_in_background = False
+    threaded_solver = False
+
+    def __init__(self, map_index=DEFAULT_MAP, send_message_cb=None, lockstep=False):
+        super().__init__('simulation', send_message_cb or (lambda room_key, message, client: None), map_index, rx_queue=LocalQueue(), lockstep=lockstep)
+        self.send_updates = send_message_cb is not None
+
+    def add_player(self, name):
+        if self.full:
+            raise ValueError(f"The map has room for {self.map['max_players']} players")
+        client = self.join(None, name)
+        self.clients.apply_pending_changes()
+        return client
+
+    def key_down(self, client, key):
+        self.rx_queue.sync_q.put({'type': 'game_event', 'client_id': client.id, 'events': [{'type': 'KEYDOWN', 'value': key}]})
+
+    def key_up(self, client, key):
+        self.rx_queue.sync_q.put({'type': 'game_event', 'client_id': client.id, 'events': [{'type': 'KEYUP', 'value': key}]})
+
+    def send_update(self, client=None):
+        if self.send_updates:
+            super().send_update(client)
+
+    def run(self, steps=1):
+        """
+        Steps the game. The key events are handled at the start of each step.
+        """
+        for _ in range(steps):
+            self.objects.apply_pending_changes()
+            self.clients.apply_pending_changes()
+            self.check_events()
+            if self.resync:
+                self.send_snapshot()
+            self.step()
+            if self.lockstep:
+                self.send_update()
+
+    def run_until(self, condition, max_steps):
+        """
+        Steps the game until the condition is true after a step, at most
+        max_steps steps. Returns whether the condition was met.
+        """
+        for _ in range(max_steps):
+            self.run()
+            if condition():
+                return True
+        return False
+
 class GameServer:
     def __init__(self, host, port):
         self.host = host
@@ -831,12 +2161,15 @@ class GameServer:
         #self.game.stop()
         for room_key, room in self.rooms.items():
             room.stop()
+        shutdown_terrain_executor()
 
         if e not in [None, KeyboardInterrupt]:
             print(traceback.format_exc())
 
-    def create_room(self, room_key):
-        return Game(room_key, self.send_message)
+    def create_room(self, room_key, map_index=None):
+        if not (type(map_index) is int and 0 <= map_index < len(MAPS)):
+            map_index = DEFAULT_MAP
+        return Game(room_key, self.send_message, map_index, lockstep=LOCKSTEP)
 
     async def destroy_room(self, room):
         #await room.rx_queue.async_q.put(None)
@@ -855,6 +2188,11 @@ class GameServer:
             print("Starting server...")
             async with websockets.serve(self.recv_thread, self.host, self.port) as socket:
                 print(f"Started at ws://{self.host}:{self.port}.")
+                # start the terrain workers now instead of on the first crater
+                executor = get_terrain_executor()
+                if executor is not None:
+                    for _ in range(TERRAIN_WORKERS):
+                        executor.submit(int)
                 send_task = asyncio.create_task( self.send_thread(socket) )
 
                 with suppress(asyncio.CancelledError):
@@ -907,7 +2245,7 @@ class GameServer:
                     
                     # If such room doesn't exist, create a new one.
                     if not room_key in self.rooms:
-                        room = self.create_room(room_key)
+                        room = self.create_room(room_key, message.get('map'))
                         self.rooms[room_key] = room
 
                         room.future = self.async_loop.run_in_executor(None, self.game_thread, room_key)
@@ -921,7 +2259,7 @@ class GameServer:
                     else:
                         client = room.join(socket, message['player_name'])
                         print(f"Player '{message['player_name']}' (client ID '{client.id}') joined to room '{room.room_key}'.")
-                        await client.socket.send(encode_msg({'type': 'joined', 'client_id': client.id}))
+                        await client.socket.send(encode_msg({'type': 'joined', 'client_id': client.id, 'map': room.map_index, 'lockstep': room.lockstep}))
 
                 elif room:  # room is already up...
                     #await self.room.rx_queue.async_q.put( decode_msg(message_raw) )